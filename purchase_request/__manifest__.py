@@ -8,9 +8,11 @@
         "security/ir.model.access.csv",
         "data/purchase_request_sequence.xml",
         "data/purchase_request_data.xml",
+        "data/purchase_request_notification_data.xml",
         "wizard/purchase_request_line_make_purchase_order_view.xml",
         "views/purchase_request_view.xml",
         "views/purchase_request_line_view.xml",
+        "views/res_config_settings_views.xml",
        
     ],
     "license": "LGPL-3",
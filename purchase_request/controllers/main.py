@@ -0,0 +1,20 @@
+# License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
+
+from odoo import _, http
+from odoo.exceptions import AccessError
+from odoo.http import request
+
+from ..profiling import get_stats, reset_stats
+
+
+class PurchaseRequestProfiling(http.Controller):
+    @http.route("/purchase_request/profiling", type="json", auth="user")
+    def profiling_stats(self, reset=False):
+        """Return the rolling aggregates of the profiled stages of this
+        worker."""
+        if not request.env.user.has_group("base.group_system"):
+            raise AccessError(_("Only administrators can read profiling data."))
+        stats = get_stats()
+        if reset:
+            reset_stats()
+        return stats
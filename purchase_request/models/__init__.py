@@ -9,3 +9,6 @@ from . import product_template
 from . import purchase_order
 from . import stock_move
 from . import stock_move_line
+from . import purchase_request_notification
+from . import res_company
+from . import res_config_settings
@@ -1,26 +1,69 @@
 # Copyright 2018-2019 ForgeFlow, S.L.
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
 
-from odoo import models
+from collections import defaultdict
+
+from odoo import api, fields, models
+
+from ..profiling import profiled
+from .purchase_request_line import ORDERPOINT_REQUEST_STATES
 
 
 class Orderpoint(models.Model):
     _inherit = "stock.warehouse.orderpoint"
 
-    def _quantity_in_progress(self):
-        res = super()._quantity_in_progress()
-        for prline in self.env["purchase.request.line"].search(
+    purchase_request_line_ids = fields.One2many(
+        comodel_name="purchase.request.line",
+        inverse_name="orderpoint_id",
+        string="Purchase Request Lines",
+    )
+    purchase_request_qty = fields.Float(
+        string="Requested Quantity",
+        compute="_compute_purchase_request_qty",
+        store=True,
+        digits="Product Unit of Measure",
+        help="Quantity of the purchase request lines of this orderpoint that are "
+        "not purchased yet, in the orderpoint unit of measure.",
+    )
+
+    @api.depends(
+        "product_uom",
+        "purchase_request_line_ids.product_qty",
+        "purchase_request_line_ids.product_uom_id",
+        "purchase_request_line_ids.request_state",
+        "purchase_request_line_ids.purchase_state",
+    )
+    @profiled()
+    def _compute_purchase_request_qty(self):
+        orderpoints = self.filtered("id")
+        groups = self.env["purchase.request.line"]._read_group(
             [
-                (
-                    "request_id.state",
-                    "in",
-                    ("draft", "approved", "to_approve", "in_progress"),
-                ),
-                ("orderpoint_id", "in", self.ids),
+                ("request_state", "in", ORDERPOINT_REQUEST_STATES),
+                ("orderpoint_id", "in", orderpoints.ids),
                 ("purchase_state", "=", False),
-            ]
-        ):
-            res[prline.orderpoint_id.id] += prline.product_uom_id._compute_quantity(
-                prline.product_qty, prline.orderpoint_id.product_uom, round=False
+            ],
+            ["orderpoint_id", "product_uom_id"],
+            ["product_qty:sum"],
+        )
+        quantities = defaultdict(float)
+        for orderpoint, uom, product_qty in groups:
+            quantities[orderpoint.id] += uom._compute_quantity(
+                product_qty, orderpoint.product_uom, round=False
             )
+        for orderpoint in orderpoints:
+            orderpoint.purchase_request_qty = quantities[orderpoint.id]
+        for orderpoint in self - orderpoints:
+            orderpoint.purchase_request_qty = sum(
+                line.product_uom_id._compute_quantity(
+                    line.product_qty, orderpoint.product_uom, round=False
+                )
+                for line in orderpoint.purchase_request_line_ids
+                if line.request_state in ORDERPOINT_REQUEST_STATES
+                and not line.purchase_state
+            )
+
+    def _quantity_in_progress(self):
+        res = super()._quantity_in_progress()
+        for orderpoint in self:
+            res[orderpoint.id] += orderpoint.purchase_request_qty
         return res
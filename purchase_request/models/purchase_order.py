@@ -1,102 +1,129 @@
 # Copyright 2018-2019 ForgeFlow, S.L.
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
 
+from collections import defaultdict
+
 from markupsafe import Markup
 
 from odoo import _, api, exceptions, fields, models
-from odoo.tools import html_escape
+
+from ..profiling import profiled
 
 
 class PurchaseOrder(models.Model):
     _inherit = "purchase.order"
 
-    def _purchase_request_confirm_message_content(self, request, request_dict=None):
+    def _purchase_request_confirm_message_header(self, request):
         self.ensure_one()
-        if not request_dict:
-            request_dict = {}
         title = _("Order confirmation %(po_name)s for your Request %(pr_name)s") % {
             "po_name": self.name,
             "pr_name": request.name,
         }
-        message = f"<h3>{title}</h3><ul>"
-        message += _(
+        message = _(
             "The following requested items from Purchase Request %(pr_name)s "
             "have now been confirmed in Purchase Order %(po_name)s:",
             po_name=self.name,
             pr_name=request.name,
         )
+        return Markup("<h3>{}</h3>{}").format(title, message)
 
-        for line in request_dict.values():
-            message += _(
-                "<li><b>%(prl_name)s</b>: Ordered quantity %(prl_qty)s %(prl_uom)s, "
-                "Planned date %(prl_date_planned)s</li>"
-            ) % {
-                "prl_name": html_escape(line["name"]),
-                "prl_qty": line["product_qty"],
-                "prl_uom": line["product_uom"],
-                "prl_date_planned": line["date_planned"],
+    def _purchase_request_confirm_message_content(self, request, request_dict=None):
+        """Deprecated, the confirmation is posted as a digest, override
+        ``_purchase_request_confirm_message_header`` instead."""
+        self.ensure_one()
+        return self.env["purchase.request"]._notify_digest_content(
+            {
+                (
+                    self._purchase_request_confirm_message_header(request),
+                    (_("Product"), _("Ordered quantity"), _("UoM"), _("Planned date")),
+                ): [
+                    (
+                        line["name"],
+                        line["product_qty"],
+                        line["product_uom"],
+                        line["date_planned"],
+                    )
+                    for line in (request_dict or {}).values()
+                ]
             }
-        message += "</ul>"
-        return message
+        )
+
+    def _get_purchase_request_lines_map(self):
+        """Read the purchase request lines of all the order lines at once.
+
+        :return: dict mapping the order line ids to their request lines, with
+            superuser rights
+        """
+        po_lines = self.sudo().order_line
+        request_lines = po_lines.purchase_request_lines
+        request_lines.fetch(["name", "purchase_state", "request_id"])
+        request_lines.request_id.fetch(["name"])
+        return {po_line.id: po_line.purchase_request_lines for po_line in po_lines}
 
-    def _purchase_request_confirm_message(self):
+    @profiled(records=lambda self, request_lines_map=None: len(self.order_line))
+    def _purchase_request_confirm_message(self, request_lines_map=None):
+        if request_lines_map is None:
+            request_lines_map = self._get_purchase_request_lines_map()
         request_obj = self.env["purchase.request"]
+        columns = (_("Product"), _("Ordered quantity"), _("UoM"), _("Planned date"))
         for po in self:
             requests_dict = {}
             for line in po.order_line:
-                for request_line in line.sudo().purchase_request_lines:
-                    request_id = request_line.request_id.id
-                    if request_id not in requests_dict:
-                        requests_dict[request_id] = {}
-                    date_planned = line.date_planned
+                for request_line in request_lines_map.get(line.id, []):
+                    request = request_line.request_id
+                    if request not in requests_dict:
+                        requests_dict[request] = {}
                     data = {
                         "name": request_line.name,
                         "product_qty": line.product_qty,
                         "product_uom": line.product_uom.name,
-                        "date_planned": date_planned,
+                        "date_planned": line.date_planned,
                     }
-                    requests_dict[request_id][request_line.id] = data
-            for request_id in requests_dict:
-                request = request_obj.sudo().browse(request_id)
-                message = po._purchase_request_confirm_message_content(
-                    request, requests_dict[request_id]
-                )
-                request.message_post(
-                    body=Markup(message),
-                    subtype_id=self.env.ref(
-                        "purchase_request.mt_request_po_confirmed"
-                    ).id,
+                    requests_dict[request][request_line.id] = data
+            for request, lines in requests_dict.items():
+                request_obj._notify_digest_add(
+                    request,
+                    "purchase_request.mt_request_po_confirmed",
+                    po._purchase_request_confirm_message_header(request),
+                    columns,
+                    [
+                        (
+                            line["name"],
+                            line["product_qty"],
+                            line["product_uom"],
+                            line["date_planned"],
+                        )
+                        for line in lines.values()
+                    ],
                 )
         return True
 
-    def _purchase_request_line_check(self):
-        for po in self:
-            for line in po.order_line:
-                for request_line in line.purchase_request_lines:
-                    if request_line.sudo().purchase_state == "done":
-                        raise exceptions.UserError(
-                            _("Purchase Request %s has already been completed")
-                            % (request_line.request_id.name)
-                        )
+    def _purchase_request_line_check(self, request_lines_map=None):
+        if request_lines_map is None:
+            request_lines_map = self._get_purchase_request_lines_map()
+        for request_lines in request_lines_map.values():
+            for request_line in request_lines:
+                if request_line.purchase_state == "done":
+                    raise exceptions.UserError(
+                        _("Purchase Request %s has already been completed")
+                        % (request_line.request_id.name)
+                    )
         return True
 
     def button_confirm(self):
-        self._purchase_request_line_check()
+        request_lines_map = self._get_purchase_request_lines_map()
+        self._purchase_request_line_check(request_lines_map)
         res = super().button_confirm()
-        self._purchase_request_confirm_message()
+        self._purchase_request_confirm_message(request_lines_map)
         return res
 
     def unlink(self):
-        alloc_to_unlink = self.env["purchase.request.allocation"]
-        for rec in self:
-            for alloc in (
-                rec.order_line.mapped("purchase_request_lines")
-                .mapped("purchase_request_allocation_ids")
-                .filtered(
-                    lambda alloc, rec=rec: alloc.purchase_line_id.order_id.id == rec.id
-                )
-            ):
-                alloc_to_unlink += alloc
+        alloc_to_unlink = self.env["purchase.request.allocation"].search(
+            [
+                ("purchase_line_id", "in", self.order_line.ids),
+                ("purchase_request_line_id", "!=", False),
+            ]
+        )
         res = super().unlink()
         alloc_to_unlink.unlink()
         return res
@@ -139,61 +166,83 @@ class PurchaseOrderLine(models.Model):
             "domain": domain,
         }
 
+    def _create_stock_moves(self, picking):
+        # Read the allocations of all the lines at once for _prepare_stock_moves
+        self.fetch(["purchase_request_allocation_ids"])
+        return super()._create_stock_moves(picking)
+
     def _prepare_stock_moves(self, picking):
         self.ensure_one()
         val = super()._prepare_stock_moves(picking)
-        all_list = []
+        po_line_model = self.env["purchase.order.line"]
         for v in val:
-            all_ids = self.env["purchase.request.allocation"].search(
-                [("purchase_line_id", "=", v["purchase_line_id"])]
-            )
-            for all_id in all_ids:
-                all_list.append((4, all_id.id))
-            v["purchase_request_allocation_ids"] = all_list
+            allocations = po_line_model.browse(
+                v["purchase_line_id"]
+            ).purchase_request_allocation_ids
+            v["purchase_request_allocation_ids"] = [
+                (4, alloc_id) for alloc_id in allocations.ids
+            ]
         return val
 
     def update_service_allocations(self, prev_qty_received):
-        for rec in self:
-            allocation = self.env["purchase.request.allocation"].search(
-                [
-                    ("purchase_line_id", "=", rec.id),
-                    ("purchase_line_id.product_id.type", "=", "service"),
-                ]
-            )
-            if not allocation:
-                return
-            qty_left = rec.qty_received - prev_qty_received
-            for alloc in allocation:
-                allocated_product_qty = alloc.allocated_product_qty
+        return self._update_service_allocations(
+            {rec.id: prev_qty_received for rec in self}
+        )
+
+    @profiled("update_service_allocations")
+    def _update_service_allocations(self, prev_qty_received):
+        """Allocate the quantity received on the service lines since
+        ``prev_qty_received``, a dictionary of the previous received
+        quantities by line id."""
+        allocation_model = self.env["purchase.request.allocation"]
+        service_lines = self.filtered(
+            lambda line: line.id in prev_qty_received
+            and line.product_id.type == "service"
+        )
+        service_lines.fetch(["purchase_request_allocation_ids"])
+        allocated = {}
+        for rec in service_lines:
+            qty_left = rec.qty_received - prev_qty_received[rec.id]
+            for alloc in rec.purchase_request_allocation_ids:
                 if not qty_left:
-                    alloc.purchase_request_line_id._compute_qty()
                     break
                 if alloc.open_product_qty <= qty_left:
-                    allocated_product_qty += alloc.open_product_qty
+                    allocated_qty = alloc.open_product_qty
                     qty_left -= alloc.open_product_qty
-                    alloc._notify_allocation(alloc.open_product_qty)
                 else:
-                    allocated_product_qty += qty_left
-                    alloc._notify_allocation(qty_left)
+                    allocated_qty = qty_left
                     qty_left = 0
-                alloc.write({"allocated_product_qty": allocated_product_qty})
+                alloc._notify_allocation(allocated_qty)
+                allocated_product_qty = alloc.allocated_product_qty + allocated_qty
+                allocated[alloc.id] = allocated_product_qty
 
                 message_data = self._prepare_request_message_data(
                     alloc, alloc.purchase_request_line_id, allocated_product_qty
                 )
-                message = self._purchase_request_confirm_done_message_content(
-                    message_data
-                )
-                alloc.purchase_request_line_id.request_id.message_post(
-                    body=Markup(message),
-                    subtype_id=self.env.ref("mail.mt_note").id,
+                self.env["purchase.request"]._notify_digest_add(
+                    alloc.purchase_request_line_id.request_id,
+                    "mail.mt_note",
+                    self._purchase_request_confirm_done_message_header(message_data),
+                    (_("Product"), _("Received quantity"), _("UoM")),
+                    [
+                        (
+                            message_data["product_name"],
+                            message_data["product_qty"],
+                            message_data["product_uom"],
+                        )
+                    ],
                 )
-
-                alloc.purchase_request_line_id._compute_qty()
+        allocations_by_qty = defaultdict(list)
+        for allocation_id, allocated_product_qty in allocated.items():
+            allocations_by_qty[allocated_product_qty].append(allocation_id)
+        for allocated_product_qty, allocation_ids in allocations_by_qty.items():
+            allocation_model.browse(allocation_ids).write(
+                {"allocated_product_qty": allocated_product_qty}
+            )
         return True
 
     @api.model
-    def _purchase_request_confirm_done_message_content(self, message_data):
+    def _purchase_request_confirm_done_message_header(self, message_data):
         title = _("Service confirmation for Request {request_name}").format(
             request_name=message_data["request_name"]
         )
@@ -206,15 +255,26 @@ class PurchaseOrderLine(models.Model):
             requestor=message_data["requestor"],
         )
 
-        product_line = Markup(
-            "<ul><li><b>{}</b>: " + _("Received quantity") + " {} {}</li></ul>"
-        ).format(
-            html_escape(message_data["product_name"]),
-            message_data["product_qty"],
-            html_escape(message_data["product_uom"]),
-        )
+        return Markup("<h3>{}</h3>{}").format(title, message_body)
 
-        return Markup("<h3>{}</h3>{}{}").format(title, message_body, product_line)
+    @api.model
+    def _purchase_request_confirm_done_message_content(self, message_data):
+        """Deprecated, the reception is posted as a digest, override
+        ``_purchase_request_confirm_done_message_header`` instead."""
+        return self.env["purchase.request"]._notify_digest_content(
+            {
+                (
+                    self._purchase_request_confirm_done_message_header(message_data),
+                    (_("Product"), _("Received quantity"), _("UoM")),
+                ): [
+                    (
+                        message_data["product_name"],
+                        message_data["product_qty"],
+                        message_data["product_uom"],
+                    )
+                ]
+            }
+        )
 
     def _prepare_request_message_data(self, alloc, request_line, allocated_qty):
         return {
@@ -237,6 +297,5 @@ class PurchaseOrderLine(models.Model):
                 prev_qty_received[line.id] = line.qty_received
         res = super().write(vals)
         if prev_qty_received:
-            for line in service_lines:
-                line.update_service_allocations(prev_qty_received[line.id])
+            service_lines._update_service_allocations(prev_qty_received)
         return res
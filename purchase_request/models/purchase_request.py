@@ -1,6 +1,10 @@
 # Copyright 2018-2019 ForgeFlow, S.L.
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
 
+from collections import defaultdict
+
+from markupsafe import Markup
+
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
 
@@ -13,6 +17,9 @@ _STATES = [
     ("rejected", "Rejected"),
 ]
 
+_NOTIFY_DIGEST_KEY = "purchase_request.notify_digest"
+_PROCUREMENT_KEY_FIELDS = {"picking_type_id", "company_id", "group_id"}
+
 
 class PurchaseRequest(models.Model):
     _name = "purchase.request"
@@ -69,7 +76,11 @@ class PurchaseRequest(models.Model):
     is_name_editable = fields.Boolean(
         default=lambda self: self.env.user.has_group("base.group_no_one"),
     )
-    origin = fields.Char(string="Source Document")
+    origin = fields.Char(
+        string="Source Document",
+        help="Origins of the procurements of the request. Past a limit, the "
+        "others are only counted, approximately, in the trailing (+N).",
+    )
     date_start = fields.Date(
         string="Creation date",
         help="Date when the user initiated the request.",
@@ -141,16 +152,29 @@ class PurchaseRequest(models.Model):
         copy=False,
         index=True,
     )
+    procurement_key = fields.Char(
+        copy=False,
+        readonly=True,
+        help="Set on the draft requests created by procurements, identifies the "
+        "procurements that can be added to this request.",
+    )
     line_count = fields.Integer(
         string="Purchase Request Line count",
         compute="_compute_line_count",
         readonly=True,
+        store=True,
     )
     move_count = fields.Integer(
-        string="Stock Move count", compute="_compute_move_count", readonly=True
+        string="Stock Move count",
+        compute="_compute_move_count",
+        readonly=True,
+        store=True,
     )
     purchase_count = fields.Integer(
-        string="Purchases count", compute="_compute_purchase_count", readonly=True
+        string="Purchases count",
+        compute="_compute_purchase_count",
+        readonly=True,
+        store=True,
     )
     currency_id = fields.Many2one(related="company_id.currency_id", readonly=True)
     estimated_cost = fields.Monetary(
@@ -164,10 +188,38 @@ class PurchaseRequest(models.Model):
         for rec in self:
             rec.estimated_cost = sum(rec.line_ids.mapped("estimated_cost"))
 
-    @api.depends("line_ids")
+    def _count_by_request(self, query):
+        """Run ``query`` for the stored requests in ``self`` and return a
+        dictionary mapping their ids to the count it returns.
+
+        The query receives a tuple of request ids and selects (request_id, count).
+        """
+        ids = tuple(rid for rid in self.ids if isinstance(rid, int))
+        if not ids:
+            return {}
+        self.env.cr.execute(query, (ids,))
+        return dict(self.env.cr.fetchall())
+
+    @api.depends("line_ids.purchase_lines.order_id")
     def _compute_purchase_count(self):
+        self.env["purchase.request.line"].flush_model(["request_id", "purchase_lines"])
+        self.env["purchase.order.line"].flush_model(["order_id"])
+        counts = self._count_by_request(
+            """
+            SELECT prl.request_id, COUNT(DISTINCT pol.order_id)
+            FROM purchase_request_line prl
+            JOIN purchase_request_purchase_order_line_rel rel
+                ON rel.purchase_request_line_id = prl.id
+            JOIN purchase_order_line pol ON pol.id = rel.purchase_order_line_id
+            WHERE prl.request_id IN %s
+            GROUP BY prl.request_id
+            """
+        )
         for rec in self:
-            rec.purchase_count = len(rec.mapped("line_ids.purchase_lines.order_id"))
+            if isinstance(rec.id, int):
+                rec.purchase_count = counts.get(rec.id, 0)
+            else:
+                rec.purchase_count = len(rec.line_ids.purchase_lines.order_id)
 
     def action_view_purchase_order(self):
         action = self.env["ir.actions.actions"]._for_xml_id("purchase.purchase_rfq")
@@ -181,12 +233,29 @@ class PurchaseRequest(models.Model):
             action["res_id"] = lines.id
         return action
 
-    @api.depends("line_ids")
+    @api.depends("line_ids.purchase_request_allocation_ids.stock_move_id")
     def _compute_move_count(self):
+        self.env["purchase.request.line"].flush_model(["request_id"])
+        self.env["purchase.request.allocation"].flush_model(
+            ["purchase_request_line_id", "stock_move_id"]
+        )
+        counts = self._count_by_request(
+            """
+            SELECT prl.request_id, COUNT(DISTINCT alloc.stock_move_id)
+            FROM purchase_request_allocation alloc
+            JOIN purchase_request_line prl
+                ON prl.id = alloc.purchase_request_line_id
+            WHERE prl.request_id IN %s
+            GROUP BY prl.request_id
+            """
+        )
         for rec in self:
-            rec.move_count = len(
-                rec.mapped("line_ids.purchase_request_allocation_ids.stock_move_id")
-            )
+            if isinstance(rec.id, int):
+                rec.move_count = counts.get(rec.id, 0)
+            else:
+                rec.move_count = len(
+                    rec.line_ids.purchase_request_allocation_ids.stock_move_id
+                )
 
     def action_view_stock_picking(self):
         action = self.env["ir.actions.actions"]._for_xml_id(
@@ -206,8 +275,20 @@ class PurchaseRequest(models.Model):
 
     @api.depends("line_ids")
     def _compute_line_count(self):
+        self.env["purchase.request.line"].flush_model(["request_id"])
+        counts = self._count_by_request(
+            """
+            SELECT request_id, COUNT(*)
+            FROM purchase_request_line
+            WHERE request_id IN %s
+            GROUP BY request_id
+            """
+        )
         for rec in self:
-            rec.line_count = len(rec.mapped("line_ids"))
+            if isinstance(rec.id, int):
+                rec.line_count = counts.get(rec.id, 0)
+            else:
+                rec.line_count = len(rec.line_ids)
 
     def action_view_purchase_request_line(self):
         action = (
@@ -249,18 +330,44 @@ class PurchaseRequest(models.Model):
             if vals.get("name", _("New")) == _("New"):
                 vals["name"] = self._get_default_name()
         requests = super().create(vals_list)
-        for vals, request in zip(vals_list, requests, strict=True):
-            if vals.get("assigned_to"):
-                partner_id = self._get_partner_id(request)
-                request.message_subscribe(partner_ids=[partner_id])
+        requests.browse(
+            [
+                request.id
+                for vals, request in zip(vals_list, requests, strict=True)
+                if vals.get("assigned_to")
+            ]
+        )._subscribe_assigned_to()
         return requests
 
+    def _subscribe_assigned_to(self):
+        """Subscribe the assignees, with one call per partner."""
+        requests_by_partner = defaultdict(list)
+        for request in self:
+            requests_by_partner[self._get_partner_id(request)].append(request.id)
+        for partner_id, request_ids in requests_by_partner.items():
+            self.browse(request_ids).message_subscribe(partner_ids=[partner_id])
+
+    def init(self):
+        # A single draft request can consolidate the procurements of a key, so
+        # concurrent procurement runs cannot create duplicates.
+        self.env.cr.execute(
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS purchase_request_procurement_key_uniq
+            ON purchase_request (procurement_key)
+            WHERE state = 'draft' AND procurement_key IS NOT NULL
+            """
+        )
+
     def write(self, vals):
+        if "procurement_key" not in vals and (
+            vals.get("state", "draft") != "draft"
+            or _PROCUREMENT_KEY_FIELDS & vals.keys()
+        ):
+            # The request does not match its procurement key anymore
+            vals = dict(vals, procurement_key=False)
         res = super().write(vals)
-        for request in self:
-            if vals.get("assigned_to"):
-                partner_id = self._get_partner_id(request)
-                request.message_subscribe(partner_ids=[partner_id])
+        if vals.get("assigned_to"):
+            self._subscribe_assigned_to()
         return res
 
     def _can_be_deleted(self):
@@ -299,17 +406,128 @@ class PurchaseRequest(models.Model):
     def check_auto_reject(self):
         """When all lines are cancelled the purchase request should be
         auto-rejected."""
-        for pr in self:
-            if not pr.line_ids.filtered(lambda line: line.cancelled is False):
-                pr.write({"state": "rejected"})
+        self.filtered(
+            lambda pr: not pr.line_ids.filtered(lambda line: line.cancelled is False)
+        ).write({"state": "rejected"})
 
     def to_approve_allowed_check(self):
-        for rec in self:
-            if not rec.to_approve_allowed:
-                raise UserError(
-                    _(
-                        "You can't request an approval for a purchase request "
-                        "which is empty. (%s)"
+        not_allowed = self.filtered(lambda rec: not rec.to_approve_allowed)
+        if not_allowed:
+            raise UserError(
+                _(
+                    "You can't request an approval for a purchase request "
+                    "which is empty. (%s)"
+                )
+                % ", ".join(not_allowed.mapped("name"))
+            )
+
+    @api.model
+    def _get_bulk_transitions(self):
+        """Target states of the bulk transitions, with the method applying
+        them and the states they can be applied from."""
+        return {
+            "to_approve": ("button_to_approve", ("draft",)),
+            "approved": ("button_approved", ("to_approve",)),
+            "in_progress": ("button_in_progress", ("approved",)),
+            "done": ("button_done", ("approved", "in_progress")),
+            "rejected": ("button_rejected", ("to_approve", "approved", "in_progress")),
+        }
+
+    def _get_bulk_transition_requests(self, state, from_states):
+        """Requests that can be moved to ``state``, the others are skipped."""
+        requests = self.filtered(lambda request: request.state in from_states)
+        if state == "to_approve":
+            # Empty requests cannot be submitted for approval
+            requests = requests.filtered("to_approve_allowed")
+        return requests
+
+    def action_bulk_transition(self, state):
+        """Move the requests that can be moved to ``state`` at once.
+
+        :return: the requests moved to ``state``
+        """
+        transitions = self._get_bulk_transitions()
+        if state not in transitions:
+            raise UserError(_("Unknown purchase request state: %s", state))
+        method, from_states = transitions[state]
+        requests = self._get_bulk_transition_requests(state, from_states)
+        if requests:
+            getattr(requests, method)()
+        return requests
+
+    @api.model
+    def _notify_digest_add(self, record, subtype_xmlid, header, columns, rows):
+        """Collect lines to notify on ``record`` when the transaction commits.
+
+        Everything collected for the same record and subtype is posted as a
+        single message, with one table of lines per header.
+        :param header: Markup introducing the lines
+        :param columns: tuple of the column titles of the lines
+        :param rows: list of tuples, one value per column
+        """
+        precommit = self.env.cr.precommit
+        if _NOTIFY_DIGEST_KEY not in precommit.data:
+            precommit.data[_NOTIFY_DIGEST_KEY] = {}
+            precommit.add(self._notify_digest_post)
+        sections = precommit.data[_NOTIFY_DIGEST_KEY].setdefault(
+            (record._name, record.id, subtype_xmlid), {}
+        )
+        sections.setdefault((header, columns), []).extend(rows)
+
+    @api.model
+    def _notify_digest_content(self, sections):
+        content = Markup()
+        for (header, columns), rows in sections.items():
+            content += Markup(
+                "{}<table class='table table-sm'><thead><tr>{}</tr></thead>"
+                "<tbody>{}</tbody></table>"
+            ).format(
+                header,
+                Markup().join(Markup("<th>{}</th>").format(col) for col in columns),
+                Markup().join(
+                    Markup("<tr>{}</tr>").format(
+                        Markup().join(Markup("<td>{}</td>").format(v) for v in row)
                     )
-                    % rec.name
+                    for row in rows
+                ),
+            )
+        return content
+
+    @api.model
+    def _notify_digest_post(self):
+        digest = self.env.cr.precommit.data.pop(_NOTIFY_DIGEST_KEY, {})
+        queued_vals = []
+        for (model, res_id, subtype_xmlid), sections in digest.items():
+            # We do sudo because the user that triggered the notification may
+            # not have permissions for purchase.request.
+            record = self.env[model].sudo().browse(res_id).exists()
+            if not record:
+                continue
+            company = (
+                record.company_id
+                if "company_id" in record._fields and record.company_id
+                else self.env.company
+            )
+            body = self._notify_digest_content(sections)
+            subtype = self.env.ref(subtype_xmlid)
+            if company.purchase_request_defer_notification:
+                queued_vals.append(
+                    {
+                        "res_model": model,
+                        "res_id": res_id,
+                        "body": body,
+                        "subtype_id": subtype.id,
+                        "author_id": self.env.user.partner_id.id,
+                        "company_id": company.id,
+                    }
                 )
+                continue
+            record.message_post(body=body, subtype_id=subtype.id)
+        if queued_vals:
+            self.env["purchase.request.notification"].sudo().create(queued_vals)
+            self.env.ref(
+                "purchase_request.ir_cron_purchase_request_notification"
+            ).sudo()._trigger()
+        # this method is called after the main flush() and just before commit();
+        # we have to flush() again in case we triggered some recomputations
+        self.env.flush_all()
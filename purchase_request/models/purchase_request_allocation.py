@@ -1,10 +1,12 @@
 # Copyright 2019 ForgeFlow, S.L.
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
 
+from collections import defaultdict
+
 from markupsafe import Markup
 
 from odoo import _, api, fields, models
-from odoo.tools import html_escape
+from odoo.tools import float_compare
 
 
 class PurchaseRequestAllocation(models.Model):
@@ -67,22 +69,15 @@ class PurchaseRequestAllocation(models.Model):
         "move, in the default UoM of the product",
     )
     open_product_qty = fields.Float(
-        string="Open Quantity", compute="_compute_open_product_qty"
+        string="Open Quantity",
+        compute="_compute_open_product_qty",
+        store=True,
+        index=True,
     )
 
     purchase_state = fields.Selection(related="purchase_line_id.state")
 
-    @api.depends(
-        "requested_product_uom_qty",
-        "allocated_product_qty",
-        "stock_move_id",
-        "stock_move_id.state",
-        "stock_move_id.product_uom_qty",
-        "stock_move_id.move_line_ids.quantity",
-        "purchase_line_id",
-        "purchase_line_id.qty_received",
-        "purchase_state",
-    )
+    @api.depends("requested_product_uom_qty", "allocated_product_qty", "purchase_state")
     def _compute_open_product_qty(self):
         for rec in self:
             if rec.purchase_state in ["cancel", "done"]:
@@ -94,24 +89,73 @@ class PurchaseRequestAllocation(models.Model):
                 if rec.open_product_qty < 0.0:
                     rec.open_product_qty = 0.0
 
+    def write(self, vals):
+        if "allocated_product_qty" not in vals:
+            return super().write(vals)
+        previous = {
+            allocation.id: (
+                allocation.allocated_product_qty,
+                allocation.open_product_qty,
+            )
+            for allocation in self
+        }
+        res = super().write(vals)
+        self._update_request_line_qty(previous)
+        return res
+
+    def _update_request_line_qty(self, previous):
+        """Keep the done and in progress quantities of the request lines in
+        line with the allocated quantities that have just been written.
+
+        :param previous: dict mapping allocation ids to their allocated and
+            open quantities before the write.
+        Lines whose open quantity did not decrease by the allocated quantity,
+        e.g. because the purchase is done or over-received, are recomputed.
+        """
+        precision = self.env["decimal.precision"].precision_get(
+            "Product Unit of Measure"
+        )
+        request_lines = self.env["purchase.request.line"]
+        deltas = defaultdict(float)
+        to_recompute = request_lines
+        for allocation in self:
+            allocated_qty, open_qty = previous[allocation.id]
+            delta = allocation.allocated_product_qty - allocated_qty
+            if not delta:
+                continue
+            request_line = allocation.purchase_request_line_id
+            if float_compare(
+                open_qty - allocation.open_product_qty,
+                delta,
+                precision_digits=precision,
+            ):
+                to_recompute |= request_line
+            else:
+                deltas[request_line.id] += delta
+        for request_line_id in to_recompute.ids:
+            deltas.pop(request_line_id, None)
+        request_lines._apply_allocation_delta(deltas)
+        if to_recompute:
+            to_recompute._compute_qty()
+
     @api.model
     def _purchase_request_confirm_done_message_content(self, message_data):
-        message = ""
-        message += _(
-            "From last reception this quantity has been "
-            "allocated to this purchase request"
+        """Deprecated, the allocation is posted as a digest, override
+        ``_purchase_request_confirm_done_message_header`` instead."""
+        return self.env["purchase.request"]._notify_digest_content(
+            {
+                (
+                    self._purchase_request_confirm_done_message_header(message_data),
+                    (_("Product"), _("Received quantity"), _("UoM")),
+                ): [
+                    (
+                        message_data["product_name"],
+                        message_data["product_qty"],
+                        message_data["product_uom"],
+                    )
+                ]
+            }
         )
-        message += "<ul>"
-        message += _(
-            "<li><b>%(product_name)s</b>: "
-            "Received quantity %(product_qty)s %(product_uom)s</li>"
-        ) % {
-            "product_name": html_escape(message_data["product_name"]),
-            "product_qty": message_data["product_qty"],
-            "product_uom": message_data["product_uom"],
-        }
-        message += "</ul>"
-        return message
 
     def _prepare_message_data(self, po_line, request, allocated_qty):
         return {
@@ -122,6 +166,15 @@ class PurchaseRequestAllocation(models.Model):
             "product_uom": po_line.product_uom.name,
         }
 
+    @api.model
+    def _purchase_request_confirm_done_message_header(self, message_data):
+        return Markup("<p>{}</p>").format(
+            _(
+                "From last reception this quantity has been "
+                "allocated to this purchase request"
+            )
+        )
+
     def _notify_allocation(self, allocated_qty):
         if not allocated_qty:
             return
@@ -129,8 +182,16 @@ class PurchaseRequestAllocation(models.Model):
             request = allocation.purchase_request_line_id.request_id
             po_line = allocation.purchase_line_id
             message_data = self._prepare_message_data(po_line, request, allocated_qty)
-            message = self._purchase_request_confirm_done_message_content(message_data)
-            request.message_post(
-                body=Markup(message),
-                subtype_id=self.env.ref("mail.mt_note").id,
+            self.env["purchase.request"]._notify_digest_add(
+                request,
+                "mail.mt_note",
+                self._purchase_request_confirm_done_message_header(message_data),
+                (_("Product"), _("Received quantity"), _("UoM")),
+                [
+                    (
+                        message_data["product_name"],
+                        message_data["product_qty"],
+                        message_data["product_uom"],
+                    )
+                ],
             )
@@ -1,8 +1,14 @@
 # Copyright 2018-2019 ForgeFlow, S.L.
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
 
+from collections import defaultdict
+
 from odoo import _, api, fields, models
 from odoo.exceptions import UserError
+from odoo.tools import float_compare
+from odoo.tools.sql import create_index
+
+from ..profiling import profiled
 
 _STATES = [
     ("draft", "Draft"),
@@ -13,6 +19,10 @@ _STATES = [
     ("rejected", "Rejected"),
 ]
 
+# Request states whose lines not yet purchased count as in progress for the
+# orderpoints
+ORDERPOINT_REQUEST_STATES = ("draft", "approved", "to_approve", "in_progress")
+
 
 class PurchaseRequestLine(models.Model):
     _name = "purchase.request.line"
@@ -119,7 +129,9 @@ class PurchaseRequestLine(models.Model):
     )
 
     orderpoint_id = fields.Many2one(
-        comodel_name="stock.warehouse.orderpoint", string="Orderpoint"
+        comodel_name="stock.warehouse.orderpoint",
+        string="Orderpoint",
+        index="btree_not_null",
     )
     purchase_request_allocation_ids = fields.One2many(
         comodel_name="purchase.request.allocation",
@@ -173,38 +185,188 @@ class PurchaseRequestLine(models.Model):
         tracking=True,
     )
 
-    @api.depends(
-        "purchase_request_allocation_ids",
-        "purchase_request_allocation_ids.stock_move_id.state",
-        "purchase_request_allocation_ids.stock_move_id",
-        "purchase_request_allocation_ids.purchase_line_id",
-        "purchase_request_allocation_ids.purchase_line_id.state",
-        "request_id.state",
-        "product_qty",
-    )
+    def init(self):
+        open_states = ", ".join(f"'{state}'" for state in ORDERPOINT_REQUEST_STATES)
+        create_index(
+            self.env.cr,
+            "purchase_request_line_orderpoint_in_progress_index",
+            self._table,
+            ["orderpoint_id", "product_uom_id"],
+            where="orderpoint_id IS NOT NULL AND purchase_state IS NULL "
+            f"AND request_state IN ({open_states})",
+        )
+        # Filters of the request line list and the orderpoint/wizard searches
+        create_index(
+            self.env.cr,
+            "purchase_request_line_open_company_product_index",
+            self._table,
+            ["company_id", "product_id"],
+            where=f"request_state IN ({open_states})",
+        )
+        create_index(
+            self.env.cr,
+            "purchase_request_line_to_buy_supplier_index",
+            self._table,
+            ["supplier_id", "date_required"],
+            where="qty_to_buy IS TRUE",
+        )
+        create_index(
+            self.env.cr,
+            "purchase_request_line_state_index",
+            self._table,
+            ["request_state", "purchase_state"],
+        )
+        create_index(
+            self.env.cr,
+            "purchase_request_line_company_date_required_index",
+            self._table,
+            ["company_id", "date_required"],
+        )
+
+    def _get_allocation_quantities(self):
+        """Aggregate the allocations of the lines with a single query.
+
+        :return: dict mapping the line ids to a dict with the ``done``,
+            ``open``, ``move_cancelled`` and ``purchase_cancelled`` quantities,
+            and whether the line has any ``allocation``.
+        """
+        res = {
+            line_id: {
+                "done": 0.0,
+                "open": 0.0,
+                "move_cancelled": 0.0,
+                "purchase_cancelled": 0.0,
+                "allocation": False,
+            }
+            for line_id in self._origin.ids
+        }
+        if not res:
+            return res
+        self.env["purchase.request.allocation"].flush_model(
+            [
+                "purchase_request_line_id",
+                "stock_move_id",
+                "purchase_line_id",
+                "allocated_product_qty",
+                "open_product_qty",
+            ]
+        )
+        self.env["stock.move"].flush_model(["state", "product_qty"])
+        self.env["purchase.order.line"].flush_model(["state", "product_qty"])
+        # Moves and PO lines shared by several allocations of a line are only
+        # counted once in the cancelled quantities.
+        self.env.cr.execute(
+            """
+            WITH allocation AS (
+                SELECT pra.purchase_request_line_id AS line_id,
+                    pra.stock_move_id,
+                    pra.purchase_line_id,
+                    COALESCE(pra.allocated_product_qty, 0.0) AS done_qty,
+                    COALESCE(pra.open_product_qty, 0.0) AS open_qty
+                FROM purchase_request_allocation pra
+                WHERE pra.purchase_request_line_id IN %s
+            )
+            SELECT a.line_id,
+                SUM(a.done_qty),
+                SUM(a.open_qty),
+                (
+                    SELECT COALESCE(SUM(sm.product_qty), 0.0)
+                    FROM stock_move sm
+                    WHERE sm.state = 'cancel' AND sm.id IN (
+                        SELECT stock_move_id FROM allocation
+                        WHERE line_id = a.line_id
+                    )
+                ),
+                (
+                    SELECT COALESCE(SUM(pol.product_qty), 0.0)
+                    FROM purchase_order_line pol
+                    WHERE pol.state = 'cancel' AND pol.id IN (
+                        SELECT purchase_line_id FROM allocation
+                        WHERE line_id = a.line_id
+                    )
+                )
+            FROM allocation a
+            GROUP BY a.line_id
+        """,
+            (tuple(res),),
+        )
+        for line_id, done, open_qty, move_cancelled, purchase_cancelled in (
+            self.env.cr.fetchall()
+        ):
+            res[line_id].update(
+                {
+                    "done": done,
+                    "open": open_qty,
+                    "move_cancelled": move_cancelled,
+                    "purchase_cancelled": purchase_cancelled,
+                    "allocation": True,
+                }
+            )
+        return res
+
+    @api.depends("product_qty", "qty_done")
+    @profiled()
     def _compute_qty_to_buy(self):
         for pr in self:
-            qty_to_buy = sum(pr.mapped("product_qty")) - sum(pr.mapped("qty_done"))
+            qty_to_buy = pr.product_qty - pr.qty_done
             pr.qty_to_buy = qty_to_buy > 0.0
             pr.pending_qty_to_receive = qty_to_buy
 
     @api.depends(
         "purchase_request_allocation_ids",
-        "purchase_request_allocation_ids.stock_move_id.state",
-        "purchase_request_allocation_ids.stock_move_id",
+        "purchase_request_allocation_ids.requested_product_uom_qty",
         "purchase_request_allocation_ids.purchase_line_id.state",
         "purchase_request_allocation_ids.purchase_line_id",
     )
+    @profiled()
     def _compute_qty(self):
+        """Full recomputation of the done and in progress quantities.
+
+        Allocated quantities are not part of the dependencies: writing them
+        on the allocations applies their deltas to the stored counters
+        through ``_apply_allocation_delta``.
+        """
+        quantities = self._get_allocation_quantities()
         for request in self:
-            done_qty = sum(
-                request.purchase_request_allocation_ids.mapped("allocated_product_qty")
-            )
-            open_qty = sum(
-                request.purchase_request_allocation_ids.mapped("open_product_qty")
+            qty = quantities.get(request._origin.id)
+            request.qty_done = qty["done"] if qty else 0.0
+            request.qty_in_progress = qty["open"] if qty else 0.0
+
+    def _apply_allocation_delta(self, deltas):
+        """Update the done and in progress counters with allocated quantities.
+
+        :param deltas: dict mapping request line ids to the quantity that has
+            just been allocated to them, in the UoM of the line.
+        Lines whose counters would become inconsistent, or that are given a
+        negative delta, fall back to a full recomputation. Lines already
+        waiting for a recomputation are left to it. Lines ending up with the
+        same counters are written at once.
+        """
+        precision = self.env["decimal.precision"].precision_get(
+            "Product Unit of Measure"
+        )
+        pending = self.env.records_to_compute(self._fields["qty_done"])
+        to_recompute = self.browse()
+        lines_by_qty = defaultdict(list)
+        for line in self.browse(list(deltas)):
+            delta = deltas[line.id]
+            if not delta or line in pending:
+                continue
+            qty_in_progress = line.qty_in_progress - delta
+            if (
+                delta < 0.0
+                or float_compare(qty_in_progress, 0.0, precision_digits=precision)
+                < 0
+            ):
+                to_recompute |= line
+                continue
+            lines_by_qty[(line.qty_done + delta, qty_in_progress)].append(line.id)
+        for (qty_done, qty_in_progress), line_ids in lines_by_qty.items():
+            self.browse(line_ids).write(
+                {"qty_done": qty_done, "qty_in_progress": qty_in_progress}
             )
-            request.qty_done = done_qty
-            request.qty_in_progress = open_qty
+        if to_recompute:
+            to_recompute._compute_qty()
 
     @api.depends(
         "purchase_request_allocation_ids",
@@ -213,33 +375,27 @@ class PurchaseRequestLine(models.Model):
         "purchase_request_allocation_ids.purchase_line_id.order_id.state",
         "purchase_request_allocation_ids.purchase_line_id",
     )
+    @profiled()
     def _compute_qty_cancelled(self):
+        quantities = self._get_allocation_quantities()
         for request in self:
+            qty = quantities.get(request._origin.id)
+            if not qty or not qty["allocation"]:
+                request.qty_cancelled = 0.0
+                continue
             if request.product_id.type != "service":
-                qty_cancelled = sum(
-                    request.mapped("purchase_request_allocation_ids.stock_move_id")
-                    .filtered(lambda sm: sm.state == "cancel")
-                    .mapped("product_qty")
-                )
+                qty_cancelled = qty["move_cancelled"]
             else:
-                qty_cancelled = sum(
-                    request.mapped("purchase_request_allocation_ids.purchase_line_id")
-                    .filtered(lambda sm: sm.state == "cancel")
-                    .mapped("product_qty")
-                )
+                qty_cancelled = qty["purchase_cancelled"]
                 # done this way as i cannot track what was received before
                 # cancelled the purchase order
                 qty_cancelled -= request.qty_done
             if request.product_uom_id:
-                request.qty_cancelled = (
-                    max(
-                        0,
-                        request.product_id.uom_id._compute_quantity(
-                            qty_cancelled, request.product_uom_id
-                        ),
-                    )
-                    if request.purchase_request_allocation_ids
-                    else 0
+                request.qty_cancelled = max(
+                    0,
+                    request.product_id.uom_id._compute_quantity(
+                        qty_cancelled, request.product_uom_id
+                    ),
                 )
             else:
                 request.qty_cancelled = qty_cancelled
@@ -298,6 +454,7 @@ class PurchaseRequestLine(models.Model):
             requests.check_auto_reject()
         return res
 
+    @profiled()
     def _compute_purchased_qty(self):
         for rec in self:
             rec.purchased_qty = 0.0
@@ -334,20 +491,48 @@ class PurchaseRequestLine(models.Model):
             rec.purchase_state = temp_purchase_state
 
     @api.model
-    def _get_supplier_min_qty(self, product, partner_id=False):
-        seller_min_qty = 0.0
-        if partner_id:
-            seller = product.seller_ids.filtered(
-                lambda r: r.partner_id == partner_id
-            ).sorted(key=lambda r: r.min_qty)
-        else:
-            seller = product.seller_ids.sorted(key=lambda r: r.min_qty)
-        if seller:
-            seller_min_qty = seller[0].min_qty
-        return seller_min_qty
+    def _get_supplier_min_qty_map(self, products, partners=None):
+        """Minimum quantities of the vendors of many products at once.
+
+        Computed with one grouped query over the supplier info of the product
+        templates. The minimum of all vendors of a product is stored under the
+        ``(product id, False)`` key, the one of a given vendor under
+        ``(product id, partner id)``.
+        :return: dict, missing keys mean no minimum quantity
+        """
+        domain = [("product_tmpl_id", "in", products.product_tmpl_id.ids)]
+        if partners:
+            domain.append(("partner_id", "in", partners.ids))
+        template_min_qty = defaultdict(dict)
+        for template, partner, min_qty in self.env[
+            "product.supplierinfo"
+        ]._read_group(
+            domain,
+            groupby=["product_tmpl_id", "partner_id"],
+            aggregates=["min_qty:min"],
+        ):
+            vendor_min_qty = template_min_qty[template.id]
+            vendor_min_qty[partner.id] = min_qty
+            vendor_min_qty[False] = min(vendor_min_qty.get(False, min_qty), min_qty)
+        return {
+            (product.id, partner_id): min_qty
+            for product in products
+            for partner_id, min_qty in template_min_qty[
+                product.product_tmpl_id.id
+            ].items()
+        }
+
+    @api.model
+    def _get_supplier_min_qty(self, product, partner_id=False, min_qty_map=None):
+        if min_qty_map is None:
+            min_qty_map = self._get_supplier_min_qty_map(product, partner_id)
+        key = (product.id, partner_id.id if partner_id else False)
+        return min_qty_map.get(key, 0.0)
 
     @api.model
-    def _calc_new_qty(self, request_line, po_line=None, new_pr_line=False):
+    def _calc_new_qty(
+        self, request_line, po_line=None, new_pr_line=False, min_qty_map=None
+    ):
         purchase_uom = po_line.product_uom or request_line.product_id.uom_po_id
         # TODO: Not implemented yet.
         #  Make sure we use the minimum quantity of the partner corresponding
@@ -355,7 +540,9 @@ class PurchaseRequestLine(models.Model):
         supplierinfo_min_qty = 0.0
         if not po_line.order_id.dest_address_id:
             supplierinfo_min_qty = self._get_supplier_min_qty(
-                po_line.product_id, po_line.order_id.partner_id
+                po_line.product_id,
+                po_line.order_id.partner_id,
+                min_qty_map=min_qty_map,
             )
 
         rl_qty = 0.0
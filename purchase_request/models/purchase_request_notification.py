@@ -0,0 +1,107 @@
+# License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
+
+import logging
+from datetime import timedelta
+
+from markupsafe import Markup
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+
+class PurchaseRequestNotification(models.Model):
+    _name = "purchase.request.notification"
+    _description = "Queued Purchase Request Notification"
+    _order = "id"
+
+    _MAX_ATTEMPTS = 5
+    _RETRY_DELAY = 10  # minutes, multiplied by the number of attempts
+
+    res_model = fields.Char(string="Document Model", required=True)
+    res_id = fields.Many2oneReference(
+        string="Document ID", model_field="res_model", required=True
+    )
+    body = fields.Html(sanitize=False)
+    subtype_id = fields.Many2one(
+        comodel_name="mail.message.subtype", string="Subtype", required=True
+    )
+    author_id = fields.Many2one(comodel_name="res.partner", string="Author")
+    company_id = fields.Many2one(comodel_name="res.company", string="Company")
+    state = fields.Selection(
+        selection=[("pending", "Pending"), ("done", "Done"), ("failed", "Failed")],
+        default="pending",
+        required=True,
+        index=True,
+    )
+    attempt = fields.Integer(string="Attempts", default=0)
+    date_next_attempt = fields.Datetime(
+        string="Next Attempt", default=fields.Datetime.now
+    )
+    error = fields.Text()
+
+    @api.model
+    def _get_pending_domain(self):
+        return [
+            ("state", "=", "pending"),
+            ("date_next_attempt", "<=", fields.Datetime.now()),
+        ]
+
+    @api.model
+    def _cron_process_notifications(self, batch_size=100):
+        """Post one batch of queued notifications; the cron is re-triggered
+        while some remain."""
+        domain = self._get_pending_domain()
+        jobs = self.search(domain, limit=batch_size)
+        jobs._process()
+        remaining = self.search_count(domain) if len(jobs) == batch_size else 0
+        self.env["ir.cron"]._notify_progress(done=len(jobs), remaining=remaining)
+        return True
+
+    def _post(self):
+        self.ensure_one()
+        record = self.env[self.res_model].sudo().browse(self.res_id).exists()
+        if not record:
+            return
+        record.message_post(
+            body=Markup(self.body or ""),
+            subtype_id=self.subtype_id.id,
+            author_id=self.author_id.id,
+        )
+
+    def _process(self):
+        done = self.browse()
+        for job in self:
+            try:
+                with self.env.cr.savepoint():
+                    job._post()
+            except Exception as e:
+                _logger.warning(
+                    "Could not post notification %s on %s,%s: %s",
+                    job.id,
+                    job.res_model,
+                    job.res_id,
+                    e,
+                )
+                attempt = job.attempt + 1
+                job.write(
+                    {
+                        "attempt": attempt,
+                        "error": str(e),
+                        "state": "failed"
+                        if attempt >= self._MAX_ATTEMPTS
+                        else "pending",
+                        "date_next_attempt": fields.Datetime.now()
+                        + timedelta(minutes=self._RETRY_DELAY * attempt),
+                    }
+                )
+            else:
+                done |= job
+        done.write({"state": "done", "error": False})
+
+    @api.autovacuum
+    def _gc_done_notifications(self):
+        limit_date = fields.Datetime.now() - timedelta(days=7)
+        self.search(
+            [("state", "=", "done"), ("write_date", "<", limit_date)]
+        ).unlink()
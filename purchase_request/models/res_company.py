@@ -0,0 +1,14 @@
+# License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
+
+from odoo import fields, models
+
+
+class ResCompany(models.Model):
+    _inherit = "res.company"
+
+    purchase_request_defer_notification = fields.Boolean(
+        string="Defer Purchase Request Notifications",
+        help="Post the purchase request receipt, confirmation and service "
+        "messages from a scheduled action instead of during the transaction "
+        "that triggers them.",
+    )
@@ -0,0 +1,12 @@
+# License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
+
+from odoo import fields, models
+
+
+class ResConfigSettings(models.TransientModel):
+    _inherit = "res.config.settings"
+
+    purchase_request_defer_notification = fields.Boolean(
+        related="company_id.purchase_request_defer_notification",
+        readonly=False,
+    )
@@ -1,6 +1,8 @@
 # Copyright 2018-2019 ForgeFlow, S.L.
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
 
+from collections import defaultdict
+
 from odoo import _, api, fields, models
 from odoo.exceptions import ValidationError
 from odoo.tools import float_compare
@@ -109,6 +111,8 @@ class StockMove(models.Model):
         if default is None:
             default = {}
         vals_list = super().copy_data(default)
+        # Remaining requested quantity of the allocations split, written at once
+        requested_qty = {}
         for move, vals in zip(self, vals_list, strict=False):
             if not default.get("purchase_request_allocation_ids") and (
                 default.get("product_uom_qty") or move.state in ("done", "cancel")
@@ -146,5 +150,14 @@ class StockMove(models.Model):
                             },
                         )
                     )
-                    alloc.requested_product_uom_qty -= open_qty
+                    requested_qty[alloc.id] = (
+                        alloc.requested_product_uom_qty - open_qty
+                    )
+        allocations_by_qty = defaultdict(list)
+        for alloc_id, qty in requested_qty.items():
+            allocations_by_qty[qty].append(alloc_id)
+        for qty, alloc_ids in allocations_by_qty.items():
+            self.env["purchase.request.allocation"].browse(alloc_ids).write(
+                {"requested_product_uom_qty": qty}
+            )
         return vals_list
@@ -1,17 +1,20 @@
 # Copyright 2017 ForgeFlow, S.L.
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
 
+from collections import defaultdict
+
 from markupsafe import Markup
 
 from odoo import _, api, models
-from odoo.tools import html_escape
+
+from ..profiling import profiled
 
 
 class StockMoveLine(models.Model):
     _inherit = "stock.move.line"
 
     @api.model
-    def _purchase_request_confirm_done_message_content(self, message_data):
+    def _purchase_request_confirm_done_message_header(self, message_data):
         title = _(
             "Receipt confirmation {picking_name} for your Request {request_name}"
         ).format(
@@ -29,18 +32,19 @@ class StockMoveLine(models.Model):
             picking_name=message_data["picking_name"],
         )
 
-        product_line = Markup(
-            "<ul><li><b>{}</b>: " + _("Transferred quantity") + " {} {}</li></ul>"
-        ).format(
-            html_escape(message_data["product_name"]),
-            message_data["product_qty"],
-            html_escape(message_data["product_uom"]),
-        )
+        return Markup("<h3>{}</h3>{}").format(title, message_body)
 
-        return Markup("<h3>{}</h3>{}{}").format(title, message_body, product_line)
+    @api.model
+    def _purchase_request_confirm_done_message_content(self, message_data, lines=None):
+        """Deprecated, the receipt is posted as a digest, override
+        ``_purchase_request_confirm_done_message_header`` instead."""
+        return self._allocation_message_content(
+            self._purchase_request_confirm_done_message_header(message_data),
+            lines or [message_data],
+        )
 
     @api.model
-    def _picking_confirm_done_message_content(self, message_data):
+    def _picking_confirm_done_message_header(self, message_data):
         title = _("Receipt confirmation for Request {name}").format(
             name=message_data["request_name"]
         )
@@ -55,15 +59,27 @@ class StockMoveLine(models.Model):
             location_name=message_data["location_name"],
         )
 
-        product_line = Markup(
-            "<ul><li><b>{}</b>: " + _("Transferred quantity") + " {} {}</li></ul>"
-        ).format(
-            html_escape(message_data["product_name"]),
-            message_data["product_qty"],
-            html_escape(message_data["product_uom"]),
+        return Markup("<h3>{}</h3>{}").format(title, message_body)
+
+    @api.model
+    def _picking_confirm_done_message_content(self, message_data, lines=None):
+        """Deprecated, the receipt is posted as a digest, override
+        ``_picking_confirm_done_message_header`` instead."""
+        return self._allocation_message_content(
+            self._picking_confirm_done_message_header(message_data),
+            lines or [message_data],
         )
 
-        return Markup("<h3>{}</h3>{}{}").format(title, message_body, product_line)
+    @api.model
+    def _allocation_message_content(self, header, lines):
+        columns = (_("Product"), _("Transferred quantity"), _("UoM"))
+        rows = [
+            (line["product_name"], line["product_qty"], line["product_uom"])
+            for line in lines
+        ]
+        return self.env["purchase.request"]._notify_digest_content(
+            {(header, columns): rows}
+        )
 
     def _prepare_message_data(self, ml, request, allocated_qty):
         return {
@@ -72,11 +88,52 @@ class StockMoveLine(models.Model):
             "product_name": ml.product_id.display_name,
             "product_qty": allocated_qty,
             "product_uom": ml.product_uom_id.name,
-            "location_name": ml.location_dest_id.display_name,
+            "location_name": (
+                ml.picking_id.location_dest_id or ml.location_dest_id
+            ).display_name,
             "requestor": request.requested_by.partner_id.name,
         }
 
+    def _post_allocation_messages(self, messages):
+        """Notify the allocated quantities on the requests and the pickings.
+
+        Notifications are collected in a digest, so that each request and each
+        picking gets a single message when the transaction is committed.
+        :param messages: dict mapping ``(request, picking)`` pairs to the list
+            of message data of the quantities allocated to the request.
+        """
+        request_model = self.env["purchase.request"]
+        columns = (_("Product"), _("Transferred quantity"), _("UoM"))
+        for (request, picking), lines in messages.items():
+            rows = [
+                (line["product_name"], line["product_qty"], line["product_uom"])
+                for line in lines
+            ]
+            request_model._notify_digest_add(
+                request,
+                "purchase_request.mt_request_picking_done",
+                self._purchase_request_confirm_done_message_header(lines[0]),
+                columns,
+                rows,
+            )
+            if picking:
+                request_model._notify_digest_add(
+                    picking,
+                    "mail.mt_note",
+                    self._picking_confirm_done_message_header(lines[0]),
+                    columns,
+                    rows,
+                )
+
+    @profiled()
     def allocate(self):
+        """Allocate the done quantities to the purchase request allocations.
+
+        Allocated quantities are computed in memory for all the move lines,
+        then written with one write per resulting quantity.
+        """
+        allocated = defaultdict(float)
+        messages = defaultdict(list)
         for ml in self.filtered(
             lambda m: m.exists() and m.move_id.purchase_request_allocation_ids
         ):
@@ -85,45 +142,37 @@ class StockMoveLine(models.Model):
             to_allocate_qty = ml.quantity
             to_allocate_uom = ml.product_uom_id
             for allocation in ml.move_id.purchase_request_allocation_ids.sudo():
-                allocated_qty = 0.0
-                if allocation.open_product_qty and to_allocate_qty:
-                    to_allocate_uom_qty = to_allocate_uom._compute_quantity(
-                        to_allocate_qty, allocation.product_uom_id
-                    )
-                    allocated_qty = min(
-                        allocation.open_product_qty, to_allocate_uom_qty
-                    )
-                    allocation.allocated_product_qty += allocated_qty
-                    to_allocate_uom_qty -= allocated_qty
-                    to_allocate_qty = allocation.product_uom_id._compute_quantity(
-                        to_allocate_uom_qty, to_allocate_uom
-                    )
-
-                request = allocation.purchase_request_line_id.request_id
+                open_qty = max(
+                    allocation.open_product_qty - allocated.get(allocation.id, 0.0),
+                    0.0,
+                )
+                if not open_qty or not to_allocate_qty:
+                    continue
+                to_allocate_uom_qty = to_allocate_uom._compute_quantity(
+                    to_allocate_qty, allocation.product_uom_id
+                )
+                allocated_qty = min(open_qty, to_allocate_uom_qty)
+                allocated[allocation.id] += allocated_qty
+                to_allocate_uom_qty -= allocated_qty
+                to_allocate_qty = allocation.product_uom_id._compute_quantity(
+                    to_allocate_uom_qty, to_allocate_uom
+                )
                 if allocated_qty:
-                    message_data = self._prepare_message_data(
-                        ml, request, allocated_qty
+                    request = allocation.purchase_request_line_id.request_id
+                    messages[(request, ml.move_id.picking_id)].append(
+                        self._prepare_message_data(ml, request, allocated_qty)
                     )
-                    message = self._purchase_request_confirm_done_message_content(
-                        message_data
-                    )
-                    if message:
-                        request.message_post(
-                            body=Markup(message),
-                            subtype_id=self.env.ref(
-                                "purchase_request.mt_request_picking_done"
-                            ).id,
-                        )
-
-                    picking_message = self._picking_confirm_done_message_content(
-                        message_data
-                    )
-                    ml.move_id.picking_id.message_post(
-                        body=Markup(picking_message),
-                        subtype_id=self.env.ref("mail.mt_note").id,
-                    )
-
-                allocation._compute_open_product_qty()
+        allocations_by_qty = defaultdict(list)
+        for allocation in self.env["purchase.request.allocation"].sudo().browse(
+            list(allocated)
+        ):
+            new_qty = allocation.allocated_product_qty + allocated[allocation.id]
+            allocations_by_qty[new_qty].append(allocation.id)
+        for new_qty, allocation_ids in allocations_by_qty.items():
+            self.env["purchase.request.allocation"].sudo().browse(
+                allocation_ids
+            ).write({"allocated_product_qty": new_qty})
+        self._post_allocation_messages(messages)
 
     def _action_done(self):
         res = super()._action_done()
@@ -1,7 +1,16 @@
 # Copyright 2018-2020 ForgeFlow, S.L.
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
 
-from odoo import api, fields, models
+import re
+
+from psycopg2.errors import UniqueViolation
+
+from odoo import _, api, fields, models
+from odoo.exceptions import ConcurrencyError
+
+from ..profiling import profiled
+
+ORIGIN_OVERFLOW_RE = re.compile(r"^(?P<origins>.*) \(\+(?P<overflow>\d+)\)$")
 
 
 class StockRule(models.Model):
@@ -80,52 +89,152 @@ class StockRule(models.Model):
         )
 
     def _run_buy(self, procurements):
-        indexes_to_pop = []
-        for i, procurement in enumerate(procurements):
+        request_procurements = []
+        buy_procurements = []
+        for procurement in procurements:
             if self.is_create_purchase_request_allowed(procurement):
-                self.create_purchase_request(procurement)
-                indexes_to_pop.append(i)
-        if indexes_to_pop:
-            indexes_to_pop.reverse()
-            for index in indexes_to_pop:
-                procurements.pop(index)
+                request_procurements.append(procurement)
+            else:
+                buy_procurements.append(procurement)
+        if request_procurements:
+            if self._is_create_purchase_request_overridden():
+                for procurement in request_procurements:
+                    self.create_purchase_request(procurement)
+            else:
+                self._create_purchase_requests(request_procurements)
+            procurements[:] = buy_procurements
         if not procurements:
             return
         return super()._run_buy(procurements)
 
+    @api.model
+    def _get_purchase_request_origin_limit(self):
+        """Maximum number of origins listed on a purchase request, the others
+        are only counted.
+
+        The count is approximate: origins left out are not remembered, so an
+        origin already counted is counted again when it comes back in a later
+        run. Within a run, origins are only counted once.
+        """
+        return 50
+
+    @api.model
+    def _parse_purchase_request_origin(self, pr_origin):
+        """Return the origins listed in ``pr_origin`` and the number of the
+        origins that were left out."""
+        if not pr_origin:
+            return [], 0
+        overflow = 0
+        match = ORIGIN_OVERFLOW_RE.match(pr_origin)
+        if match:
+            pr_origin = match.group("origins")
+            overflow = int(match.group("overflow"))
+        return pr_origin.split(", "), overflow
+
+    @api.model
+    def _format_purchase_request_origin(self, origins, overflow):
+        origin = ", ".join(origins)
+        if overflow:
+            origin = f"{origin} (+{overflow})"
+        return origin
+
+    @api.model
+    def _get_procurement_key(self, domain):
+        """Identify the draft purchase request matching ``domain``."""
+        return repr(tuple(domain))
+
+    @profiled(
+        "create_purchase_request",
+        records=lambda self, procurements: len(procurements),
+    )
+    def _create_purchase_requests(self, procurements):
+        """
+        Create purchase request lines for a list of (procurement, rule).
+
+        Procurements sharing the same purchase request domain are added to a
+        single request, which is searched or created only once.
+        """
+        purchase_request_model = self.env["purchase.request"]
+        groups = {}
+        for index, (procurement, rule) in enumerate(procurements):
+            domain = rule._make_pr_get_domain(procurement.values)
+            key = domain or index
+            if key not in groups:
+                pr = purchase_request_model
+                if domain:
+                    pr = purchase_request_model.search(list(domain), limit=1)
+                groups[key] = [pr, []]
+            groups[key][1].append((procurement, rule))
+        keys_to_create = [key for key, (pr, _items) in groups.items() if not pr]
+        procurement_keys = {
+            self._get_procurement_key(key): key
+            for key in keys_to_create
+            if not isinstance(key, int)
+        }
+        if procurement_keys:
+            # A request can keep its key while no longer matching the domain
+            for pr in purchase_request_model.search(
+                [
+                    ("procurement_key", "in", list(procurement_keys)),
+                    ("state", "=", "draft"),
+                ]
+            ):
+                groups[procurement_keys[pr.procurement_key]][0] = pr
+            keys_to_create = [key for key in keys_to_create if not groups[key][0]]
+        if keys_to_create:
+            request_data = []
+            for key in keys_to_create:
+                procurement, rule = groups[key][1][0]
+                vals = rule._prepare_purchase_request(
+                    procurement.origin, procurement.values
+                )
+                if not isinstance(key, int):
+                    vals["procurement_key"] = self._get_procurement_key(key)
+                request_data.append(vals)
+            try:
+                with self.env.cr.savepoint():
+                    new_requests = purchase_request_model.create(request_data)
+            except UniqueViolation as e:
+                # Another transaction created a draft request for the same
+                # key, retry to extend it instead.
+                raise ConcurrencyError(
+                    _("A purchase request is being created by another process.")
+                ) from e
+            for key, pr in zip(keys_to_create, new_requests, strict=True):
+                groups[key][0] = pr
+        limit = self._get_purchase_request_origin_limit()
+        request_line_data = []
+        for pr, items in groups.values():
+            origins, overflow = self._parse_purchase_request_origin(pr.origin)
+            known_origins = set(origins)
+            for procurement, rule in items:
+                origin = procurement.origin
+                if origin and origin != "/" and origin not in known_origins:
+                    known_origins.add(origin)
+                    if len(origins) < limit:
+                        origins.append(origin)
+                    else:
+                        overflow += 1
+                request_line_data.append(
+                    rule._prepare_purchase_request_line(pr, procurement)
+                )
+            origin = self._format_purchase_request_origin(origins, overflow)
+            if origin != (pr.origin or ""):
+                pr.write({"origin": origin})
+        return self.env["purchase.request.line"].create(request_line_data)
+
     def create_purchase_request(self, procurement_group):
         """
         Create a purchase request containing procurement order product.
+
+        Deprecated, extend ``_create_purchase_requests`` instead. When this
+        method is overridden, ``_run_buy`` still calls it once per
+        procurement, without batching.
         """
-        procurement = procurement_group[0]
-        rule = procurement_group[1]
-        purchase_request_model = self.env["purchase.request"]
-        purchase_request_line_model = self.env["purchase.request.line"]
-        cache = {}
-        pr = self.env["purchase.request"]
-        domain = rule._make_pr_get_domain(procurement.values)
-        if domain in cache:
-            pr = cache[domain]
-        elif domain:
-            pr = self.env["purchase.request"].search([dom for dom in domain])
-            pr = pr[0] if pr else False
-            cache[domain] = pr
-        if not pr:
-            request_data = rule._prepare_purchase_request(
-                procurement.origin, procurement.values
-            )
-            pr = purchase_request_model.create(request_data)
-            cache[domain] = pr
-        elif (
-            not pr.origin
-            or procurement.origin not in pr.origin.split(", ")
-            and procurement.origin != "/"
-        ):
-            if pr.origin:
-                if procurement.origin:
-                    pr.write({"origin": pr.origin + ", " + procurement.origin})
-            else:
-                pr.write({"origin": procurement.origin})
-        # Create Line
-        request_line_data = rule._prepare_purchase_request_line(pr, procurement)
-        purchase_request_line_model.create(request_line_data)
+        return self._create_purchase_requests([procurement_group])
+
+    def _is_create_purchase_request_overridden(self):
+        return (
+            type(self).create_purchase_request
+            is not StockRule.create_purchase_request
+        )
@@ -0,0 +1,103 @@
+# License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
+"""Opt-in timing of the purchase request hot paths.
+
+Enabled by setting the ``purchase_request.profiling`` system parameter. Each
+call of a decorated method is then logged with its wall time, number of SQL
+queries and number of records, and added to rolling per-process aggregates
+(see :func:`get_stats`).
+"""
+
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+_logger = logging.getLogger(__name__)
+
+PROFILING_PARAM = "purchase_request.profiling"
+# Number of calls kept per stage for the rolling aggregates
+WINDOW = 500
+
+_lock = threading.Lock()
+_samples = defaultdict(lambda: deque(maxlen=WINDOW))
+
+
+def is_enabled(env):
+    return bool(env["ir.config_parameter"].sudo().get_param(PROFILING_PARAM))
+
+
+def profiled(stage=None, records=None):
+    """Decorate a model method to profile its calls under ``stage``, by
+    default the method name.
+
+    ``records`` is called with the arguments of the method to count the
+    records it processes, by default the records it is called on.
+    """
+
+    def decorator(method):
+        name = stage or method.__name__
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not is_enabled(self.env):
+                return method(self, *args, **kwargs)
+            count = records(self, *args, **kwargs) if records else len(self)
+            cr = self.env.cr
+            queries = cr.sql_log_count
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                _record(
+                    name,
+                    self._name,
+                    time.perf_counter() - start,
+                    cr.sql_log_count - queries,
+                    count,
+                )
+
+        return wrapper
+
+    return decorator
+
+
+def _record(stage, model, duration, queries, records):
+    _logger.info(
+        "purchase_request profiling stage=%s model=%s records=%d queries=%d "
+        "duration_ms=%.1f",
+        stage,
+        model,
+        records,
+        queries,
+        duration * 1000,
+    )
+    with _lock:
+        _samples[stage].append((duration, queries, records))
+
+
+def get_stats():
+    """Return the aggregates of the last calls of each profiled stage."""
+    with _lock:
+        samples = {stage: list(calls) for stage, calls in _samples.items()}
+    stats = {}
+    for stage, calls in samples.items():
+        if not calls:
+            continue
+        durations = sorted(call[0] for call in calls)
+        count = len(calls)
+        stats[stage] = {
+            "calls": count,
+            "duration_ms_avg": sum(durations) / count * 1000,
+            "duration_ms_p95": durations[int(0.95 * (count - 1))] * 1000,
+            "duration_ms_max": durations[-1] * 1000,
+            "queries_avg": sum(call[1] for call in calls) / count,
+            "queries_max": max(call[1] for call in calls),
+            "records_avg": sum(call[2] for call in calls) / count,
+        }
+    return stats
+
+
+def reset_stats():
+    with _lock:
+        _samples.clear()
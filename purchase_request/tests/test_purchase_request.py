@@ -5,6 +5,13 @@ from odoo import SUPERUSER_ID, exceptions
 from odoo.exceptions import UserError
 from odoo.tests import Form, TransactionCase
 
+from odoo.addons.purchase_request.profiling import (
+    PROFILING_PARAM,
+    get_stats,
+    profiled,
+    reset_stats,
+)
+
 
 class TestPurchaseRequest(TransactionCase):
     def setUp(self):
@@ -310,3 +317,47 @@ class TestPurchaseRequest(TransactionCase):
         pr.button_draft()
         self.assertEqual(pr.state, "draft", "Should be in state draft")
         pr_lines.unlink()
+
+    def test_profiling(self):
+        line = self.purchase_request.line_ids
+        reset_stats()
+        line.write({"product_qty": 6.0})
+        self.env.flush_all()
+        self.assertNotIn("_compute_qty_to_buy", get_stats())
+        self.env["ir.config_parameter"].sudo().set_param(PROFILING_PARAM, "1")
+        with self.assertLogs("odoo.addons.purchase_request.profiling", "INFO"):
+            line.write({"product_qty": 7.0})
+            self.env.flush_all()
+        stats = get_stats()["_compute_qty_to_buy"]
+        self.assertEqual(stats["calls"], 1)
+        self.assertEqual(stats["records_avg"], 1)
+        # Methods can count the records they process from their arguments
+        method = profiled("test_records", records=lambda rec, items: len(items))(
+            lambda rec, items: items
+        )
+        with self.assertLogs("odoo.addons.purchase_request.profiling", "INFO"):
+            method(line, [1, 2, 3])
+        self.assertEqual(get_stats()["test_records"]["records_avg"], 3)
+        reset_stats()
+
+    def test_bulk_transition(self):
+        requests = self.purchase_request | self.purchase_request.copy()
+        requests.line_ids.copy({"request_id": requests[1].id})
+        empty_request = self.purchase_request_obj.create(
+            {"picking_type_id": self.picking_type_id.id}
+        )
+        # Empty requests are skipped instead of aborting the whole batch
+        self.assertEqual(
+            (requests | empty_request).action_bulk_transition("to_approve"), requests
+        )
+        self.assertEqual(set(requests.mapped("state")), {"to_approve"})
+        self.assertEqual(empty_request.state, "draft")
+        # Requests that cannot be approved are left as they are
+        self.assertEqual(
+            (requests | empty_request).action_bulk_transition("approved"), requests
+        )
+        self.assertEqual(set(requests.mapped("state")), {"approved"})
+        self.assertEqual(empty_request.state, "draft")
+        requests.action_bulk_transition("rejected")
+        self.assertEqual(set(requests.mapped("state")), {"rejected"})
+        self.assertTrue(all(requests.line_ids.mapped("cancelled")))
@@ -1,6 +1,8 @@
 # Copyright 2018-2019 ForgeFlow, S.L.
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
 
+from unittest.mock import patch
+
 from odoo import SUPERUSER_ID
 from odoo.tests import Form, common
 
@@ -202,6 +204,60 @@ class TestPurchaseRequestToRfq(common.TransactionCase):
         po_line.write({"qty_received": 2.0})
         self.assertEqual(purchase_request_line2.qty_done, 2.0)
 
+    def test_purchase_request_deferred_notification(self):
+        self.env.company.purchase_request_defer_notification = True
+        purchase_request = self.purchase_request.create(
+            {
+                "picking_type_id": self.env.ref("stock.picking_type_in").id,
+                "requested_by": SUPERUSER_ID,
+            }
+        )
+        request_line = self.purchase_request_line.create(
+            {
+                "request_id": purchase_request.id,
+                "product_id": self.service_product.id,
+                "product_uom_id": self.env.ref("uom.product_uom_unit").id,
+                "product_qty": 2.0,
+            }
+        )
+        purchase_request.button_approved()
+        self.wiz.with_context(
+            active_model="purchase.request.line", active_ids=[request_line.id]
+        ).create(
+            {"supplier_id": self.env.ref("base.res_partner_1").id}
+        ).make_purchase_order()
+        po_line = request_line.purchase_lines
+        po_line.write({"price_unit": 10})
+        po_line.order_id.button_confirm()
+        po_line.write({"qty_received": 2.0})
+        self.env.cr.flush()
+        confirm_subtype = self.env.ref("purchase_request.mt_request_po_confirmed")
+        purchase_request.invalidate_recordset(["message_ids"])
+        self.assertFalse(
+            purchase_request.message_ids.filtered(
+                lambda m: m.subtype_id == confirm_subtype
+            )
+        )
+        jobs = self.env["purchase.request.notification"].search(
+            [
+                ("res_model", "=", "purchase.request"),
+                ("res_id", "=", purchase_request.id),
+            ]
+        )
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(set(jobs.mapped("state")), {"pending"})
+        self.env["purchase.request.notification"]._cron_process_notifications()
+        self.assertEqual(set(jobs.mapped("state")), {"done"})
+        purchase_request.invalidate_recordset(["message_ids"])
+        self.assertEqual(
+            len(
+                purchase_request.message_ids.filtered(
+                    lambda m: m.subtype_id == confirm_subtype
+                )
+            ),
+            1,
+        )
+
     def test_purchase_request_allocation_min_qty(self):
         vals = {
             "picking_type_id": self.env.ref("stock.picking_type_in").id,
@@ -235,6 +291,133 @@ class TestPurchaseRequestToRfq(common.TransactionCase):
             2.0,
         )
 
+    def test_apply_allocation_delta(self):
+        vals = {
+            "picking_type_id": self.env.ref("stock.picking_type_in").id,
+            "requested_by": SUPERUSER_ID,
+        }
+        purchase_request = self.purchase_request.create(vals)
+        vals = {
+            "request_id": purchase_request.id,
+            "product_id": self.product_product.id,
+            "product_uom_id": self.env.ref("uom.product_uom_unit").id,
+            "product_qty": 2.0,
+        }
+        request_line = self.purchase_request_line.create(vals)
+        purchase_request.button_approved()
+        wiz_id = self.wiz.with_context(
+            active_model="purchase.request.line", active_ids=request_line.ids
+        ).create({"supplier_id": self.env.ref("base.res_partner_1").id})
+        wiz_id.make_purchase_order()
+        self.assertEqual(request_line.qty_in_progress, 2.0)
+        request_line._apply_allocation_delta({request_line.id: 0.5})
+        self.assertEqual(request_line.qty_done, 0.5)
+        self.assertEqual(request_line.qty_in_progress, 1.5)
+        self.assertEqual(request_line.pending_qty_to_receive, 1.5)
+        # An inconsistent delta falls back to a full recomputation
+        request_line._apply_allocation_delta({request_line.id: 5.0})
+        self.assertEqual(request_line.qty_done, 0.0)
+        self.assertEqual(request_line.qty_in_progress, 2.0)
+        # Lines ending up with the same counters are written at once
+        request_line2 = self.purchase_request_line.create(vals)
+        (request_line | request_line2).write({"qty_done": 0.5, "qty_in_progress": 1.5})
+        line_class = type(request_line)
+        with patch.object(
+            line_class, "write", autospec=True, wraps=line_class.write
+        ) as write:
+            request_line._apply_allocation_delta(
+                {request_line.id: 0.5, request_line2.id: 0.5}
+            )
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual((request_line | request_line2).mapped("qty_done"), [1.0, 1.0])
+        request_line._compute_qty()
+        # Writing the allocated quantity updates the request line
+        allocation = request_line.purchase_request_allocation_ids
+        allocation.allocated_product_qty = 1.5
+        self.assertEqual(request_line.qty_done, 1.5)
+        self.assertEqual(request_line.qty_in_progress, 0.5)
+        # Over-allocation and reverts are recomputed
+        allocation.allocated_product_qty = 3.0
+        self.assertEqual(request_line.qty_done, 3.0)
+        self.assertEqual(request_line.qty_in_progress, 0.0)
+        allocation.allocated_product_qty = 0.0
+        self.assertEqual(request_line.qty_done, 0.0)
+        self.assertEqual(request_line.qty_in_progress, 2.0)
+
+    def test_deprecated_message_content(self):
+        message_data = {
+            "request_name": "PR-TEST",
+            "picking_name": "WH/IN/TEST",
+            "po_name": "PO-TEST",
+            "product_name": "Product <Test>",
+            "product_qty": 2.0,
+            "product_uom": "Units",
+            "location_name": "WH/Stock",
+            "requestor": "Requestor",
+        }
+        for model, method in (
+            ("stock.move.line", "_purchase_request_confirm_done_message_content"),
+            ("stock.move.line", "_picking_confirm_done_message_content"),
+            ("purchase.order.line", "_purchase_request_confirm_done_message_content"),
+            (
+                "purchase.request.allocation",
+                "_purchase_request_confirm_done_message_content",
+            ),
+        ):
+            content = getattr(self.env[model], method)(message_data)
+            self.assertIn("Product &lt;Test&gt;", content)
+
+    def test_supplier_min_qty_map(self):
+        product = self.product_product
+        vendor1 = self.env.ref("base.res_partner_1")
+        vendor2 = self.env.ref("base.res_partner_12")
+        for vendor, min_qty in ((vendor1, 8.0), (vendor1, 6.0), (vendor2, 4.0)):
+            self.env["product.supplierinfo"].create(
+                {
+                    "partner_id": vendor.id,
+                    "product_tmpl_id": product.product_tmpl_id.id,
+                    "min_qty": min_qty,
+                }
+            )
+        min_qty_map = self.purchase_request_line._get_supplier_min_qty_map(product)
+        self.assertEqual(min_qty_map[(product.id, vendor1.id)], 6.0)
+        self.assertEqual(min_qty_map[(product.id, vendor2.id)], 4.0)
+        # The vendor created in the setup has no minimum quantity
+        self.assertEqual(min_qty_map[(product.id, False)], 0.0)
+        self.assertEqual(
+            self.purchase_request_line._get_supplier_min_qty(product, vendor1), 6.0
+        )
+        self.assertEqual(
+            self.purchase_request_line._get_supplier_min_qty(
+                product, self.env["res.partner"]
+            ),
+            0.0,
+        )
+        # The wizard sizes the PO line with _calc_new_qty, fed with the map
+        purchase_request = self.purchase_request.create(
+            {"picking_type_id": self.env.ref("stock.picking_type_in").id}
+        )
+        request_line = self.purchase_request_line.create(
+            {
+                "request_id": purchase_request.id,
+                "product_id": product.id,
+                "product_uom_id": self.env.ref("uom.product_uom_unit").id,
+                "product_qty": 2.0,
+            }
+        )
+        purchase_request.button_approved()
+        wiz = self.wiz.with_context(
+            active_model="purchase.request.line", active_ids=request_line.ids
+        ).create({"supplier_id": vendor1.id})
+        line_class = type(self.purchase_request_line)
+        with patch.object(
+            line_class, "_calc_new_qty", autospec=True, wraps=line_class._calc_new_qty
+        ) as calc_new_qty:
+            wiz.make_purchase_order()
+        self.assertEqual(calc_new_qty.call_count, 1)
+        self.assertIsNotNone(calc_new_qty.call_args.kwargs["min_qty_map"])
+        self.assertEqual(request_line.purchase_lines.product_qty, 6.0)
+
     def test_purchase_request_stock_allocation(self):
         product = self.env.ref("product.product_product_6")
         product.uom_po_id = self.env.ref("uom.product_uom_dozen")
@@ -307,6 +490,16 @@ class TestPurchaseRequestToRfq(common.TransactionCase):
             1.0,
         )
         purchase.button_confirm()
+        self.assertEqual(purchase_request.line_count, 2)
+        self.assertEqual(purchase_request.purchase_count, 1)
+        # Both lines are allocated to the same move, which is counted once
+        self.assertEqual(purchase_request.move_count, 1)
+        self.assertEqual(
+            self.purchase_request.search(
+                [("id", "=", purchase_request.id), ("move_count", "=", 1)]
+            ),
+            purchase_request,
+        )
         picking = purchase.picking_ids[0]
         picking.move_line_ids[0].write({"quantity": 24.0})
         picking.button_validate()
@@ -326,6 +519,20 @@ class TestPurchaseRequestToRfq(common.TransactionCase):
                 0
             ].requested_product_uom_qty,
         )
+        # Both lines are reported in a single receipt message, posted when
+        # the transaction is about to commit
+        self.env.cr.flush()
+        purchase_request.invalidate_recordset(["message_ids"])
+        picking.invalidate_recordset(["message_ids"])
+        receipt_messages = purchase_request.message_ids.filtered(
+            lambda m: m.subtype_id
+            == self.env.ref("purchase_request.mt_request_picking_done")
+        )
+        self.assertEqual(len(receipt_messages), 1)
+        picking_messages = picking.message_ids.filtered(
+            lambda m: purchase_request.name in (m.body or "")
+        )
+        self.assertEqual(len(picking_messages), 1)
 
     def test_purchase_request_stock_allocation_unlink(self):
         product = self.env.ref("product.product_product_6")
@@ -0,0 +1,384 @@
+# License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
+
+import json
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from odoo.tests import common, tagged
+from odoo.tools import SQL
+
+from odoo.addons.purchase_request.models.purchase_request_line import (
+    ORDERPOINT_REQUEST_STATES,
+)
+
+_logger = logging.getLogger(__name__)
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "benchmark_baselines.json")
+
+
+@tagged("-standard", "post_install", "-at_install", "purchase_request_benchmark")
+class TestPurchaseRequestBenchmark(common.TransactionCase):
+    """Measure the purchase request lifecycle on generated data.
+
+    Not part of the standard test run, use
+    ``--test-tags purchase_request_benchmark``. The volumes can be set with
+    the ``PURCHASE_REQUEST_BENCHMARK_VOLUMES`` environment variable, e.g.
+    ``10,100,1000``. Query counts are checked against
+    ``benchmark_baselines.json``, which is only rewritten with the measured
+    values when ``PURCHASE_REQUEST_BENCHMARK_UPDATE`` is set. Stages without
+    a baseline are only logged.
+
+    Each scenario runs twice: once for the queries and the time, once with
+    tracemalloc for the peak memory, as tracing distorts the timings.
+
+    The query plans of the request line filters are checked on
+    ``PURCHASE_REQUEST_BENCHMARK_PLAN_LINES`` generated lines, 1,000,000 by
+    default, with and without the index created for each of them.
+    """
+
+    # Allowed growth over the baseline before failing or warning
+    QUERY_TOLERANCE = 1.1
+    TIME_TOLERANCE = 1.5
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.volumes = [
+            int(volume)
+            for volume in os.environ.get(
+                "PURCHASE_REQUEST_BENCHMARK_VOLUMES", "10,100"
+            ).split(",")
+        ]
+        cls.update_baselines = bool(
+            os.environ.get("PURCHASE_REQUEST_BENCHMARK_UPDATE")
+        )
+        cls.baselines = {}
+        if os.path.exists(BASELINES_PATH):
+            with open(BASELINES_PATH) as baselines_file:
+                cls.baselines = json.load(baselines_file)
+        cls.results = {}
+        cls.trace_memory = False
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.update_baselines and cls.results:
+            for stage, volumes in cls.results.items():
+                cls.baselines.setdefault(stage, {}).update(volumes)
+            with open(BASELINES_PATH, "w") as baselines_file:
+                json.dump(cls.baselines, baselines_file, indent=4, sort_keys=True)
+                baselines_file.write("\n")
+        super().tearDownClass()
+
+    def _run_passes(self, scenario):
+        for volume in self.volumes:
+            for trace_memory in (False, True):
+                with self.subTest(volume=volume, trace_memory=trace_memory):
+                    self.trace_memory = trace_memory
+                    scenario(volume)
+
+    def _generate_data(self, volume, product_type="consu"):
+        vendors = self.env["res.partner"].create(
+            [
+                {"name": f"Benchmark Vendor {i}", "is_company": True}
+                for i in range(volume // 10 + 1)
+            ]
+        )
+        products = self.env["product.product"].create(
+            [
+                {
+                    "name": f"Benchmark Product {product_type} {i}",
+                    "type": product_type,
+                    "is_storable": product_type == "consu",
+                    "seller_ids": [
+                        (
+                            0,
+                            0,
+                            {
+                                "partner_id": vendors[i % len(vendors)].id,
+                                "min_qty": i % 3,
+                            },
+                        )
+                    ],
+                }
+                for i in range(volume)
+            ]
+        )
+        return vendors, products
+
+    @contextmanager
+    def _measure(self, stage, volume):
+        self.env.cr.flush()
+        self.env.invalidate_all()
+        result = self.results.setdefault(stage, {}).setdefault(str(volume), {})
+        if self.trace_memory:
+            tracemalloc.start()
+            try:
+                yield
+                self.env.cr.flush()
+                peak_memory = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            result["memory"] = peak_memory
+            _logger.info(
+                "Benchmark %s x%s: %s bytes peak", stage, volume, peak_memory
+            )
+            return
+        queries = self.env.cr.sql_log_count
+        start = time.perf_counter()
+        yield
+        # Include the work postponed to the flush and the commit
+        self.env.cr.flush()
+        duration = time.perf_counter() - start
+        queries = self.env.cr.sql_log_count - queries
+        result.update({"queries": queries, "time": round(duration, 3)})
+        _logger.info(
+            "Benchmark %s x%s: %s queries, %.3fs", stage, volume, queries, duration
+        )
+        if self.update_baselines:
+            return
+        baseline = self.baselines.get(stage, {}).get(str(volume))
+        if not baseline:
+            _logger.warning(
+                "Benchmark %s x%s: no baseline, record it by running the "
+                "benchmark with PURCHASE_REQUEST_BENCHMARK_UPDATE=1",
+                stage,
+                volume,
+            )
+            return
+        if duration > baseline["time"] * self.TIME_TOLERANCE:
+            _logger.warning(
+                "Benchmark %s x%s: %.3fs, baseline %.3fs",
+                stage,
+                volume,
+                duration,
+                baseline["time"],
+            )
+        self.assertLessEqual(
+            queries,
+            baseline["queries"] * self.QUERY_TOLERANCE,
+            f"{stage} x{volume}: {queries} queries, baseline "
+            f"{baseline['queries']}",
+        )
+
+    def _request_to_purchase(self, volume, products, vendor, prefix):
+        with self._measure(f"{prefix}create", volume):
+            request = self.env["purchase.request"].create(
+                {
+                    "line_ids": [
+                        (
+                            0,
+                            0,
+                            {
+                                "product_id": product.id,
+                                "product_uom_id": product.uom_id.id,
+                                "product_qty": 5.0,
+                            },
+                        )
+                        for product in products
+                    ]
+                }
+            )
+        with self._measure(f"{prefix}approve", volume):
+            request.button_to_approve()
+            request.button_approved()
+        with self._measure(f"{prefix}wizard", volume):
+            wizard = (
+                self.env["purchase.request.line.make.purchase.order"]
+                .with_context(
+                    active_model="purchase.request.line",
+                    active_ids=request.line_ids.ids,
+                )
+                .create({"supplier_id": vendor.id})
+            )
+            wizard.make_purchase_order()
+        purchase = request.line_ids.purchase_lines.order_id
+        purchase.order_line.write({"price_unit": 10.0})
+        with self._measure(f"{prefix}confirm", volume):
+            purchase.button_confirm()
+        return request, purchase
+
+    def _lifecycle(self, volume):
+        vendors, products = self._generate_data(volume)
+        request, purchase = self._request_to_purchase(volume, products, vendors[0], "")
+        picking = purchase.picking_ids
+        for move in picking.move_ids:
+            move.quantity = move.product_uom_qty
+        with self._measure("receipt", volume):
+            picking.button_validate()
+        self.assertEqual(request.line_ids.mapped("qty_done"), [5.0] * volume)
+
+    def _service_lifecycle(self, volume):
+        vendors, products = self._generate_data(volume, "service")
+        request, purchase = self._request_to_purchase(
+            volume, products, vendors[0], "service_"
+        )
+        with self._measure("service_receipt", volume):
+            purchase.order_line.write({"qty_received": 5.0})
+        self.assertEqual(request.line_ids.mapped("qty_done"), [5.0] * volume)
+
+    def test_lifecycle(self):
+        self._run_passes(self._lifecycle)
+
+    def test_service_lifecycle(self):
+        self._run_passes(self._service_lifecycle)
+
+    def _generate_request_lines(self, count, products, vendors, orderpoints):
+        """Insert ``count`` request lines spread over the given records, with
+        SQL as creating them through the ORM would take hours."""
+        state_field = self.env["purchase.request"]._fields["state"]
+        request_states = [
+            state for state, _label in state_field._description_selection(self.env)
+        ]
+        self.env.cr.execute(
+            """
+            INSERT INTO purchase_request_line (
+                name, company_id, product_id, supplier_id, date_required,
+                request_state, purchase_state, qty_to_buy, orderpoint_id
+            )
+            SELECT 'Benchmark line',
+                %(company_id)s,
+                (%(product_ids)s)[1 + i %% %(products)s],
+                (%(vendor_ids)s)[1 + i %% %(vendors)s],
+                DATE '2024-01-01' + i %% 1000,
+                (%(request_states)s)[1 + i %% %(request_state_count)s],
+                CASE WHEN i %% 50 = 0 THEN 'purchase'
+                    WHEN i %% 7 = 0 THEN 'draft' END,
+                i %% 2 = 0,
+                CASE WHEN i %% 100 = 0
+                    THEN (%(orderpoint_ids)s)[1 + i / 100 %% %(orderpoints)s] END
+            FROM generate_series(1, %(count)s) AS i
+            """,
+            {
+                "company_id": self.env.company.id,
+                "product_ids": products.ids,
+                "products": len(products),
+                "vendor_ids": vendors.ids,
+                "vendors": len(vendors),
+                "request_states": request_states,
+                "request_state_count": len(request_states),
+                "orderpoint_ids": orderpoints.ids,
+                "orderpoints": len(orderpoints),
+                "count": count,
+            },
+        )
+        self.env.cr.execute("ANALYZE purchase_request_line")
+
+    def _get_plan_scenarios(self, products, vendors, orderpoints):
+        """Filters of the request line list and of the orderpoint and wizard
+        searches, with the index created for each of them."""
+        company_id = self.env.company.id
+        open_states = list(ORDERPOINT_REQUEST_STATES)
+        return {
+            "open_company_product": (
+                "purchase_request_line_open_company_product_index",
+                [
+                    ("company_id", "=", company_id),
+                    ("product_id", "=", products[0].id),
+                    ("request_state", "in", open_states),
+                ],
+                None,
+            ),
+            "to_buy_supplier": (
+                "purchase_request_line_to_buy_supplier_index",
+                [("supplier_id", "=", vendors[0].id), ("qty_to_buy", "=", True)],
+                "date_required",
+            ),
+            "state": (
+                "purchase_request_line_state_index",
+                [
+                    ("request_state", "=", "approved"),
+                    ("purchase_state", "=", "purchase"),
+                ],
+                None,
+            ),
+            "company_date_required": (
+                "purchase_request_line_company_date_required_index",
+                [
+                    ("company_id", "=", company_id),
+                    ("date_required", ">=", "2024-03-01"),
+                    ("date_required", "<", "2024-03-08"),
+                ],
+                None,
+            ),
+            "orderpoint_in_progress": (
+                "purchase_request_line_orderpoint_in_progress_index",
+                [
+                    ("orderpoint_id", "in", orderpoints[:5].ids),
+                    ("purchase_state", "=", False),
+                    ("request_state", "in", open_states),
+                ],
+                None,
+            ),
+        }
+
+    def _explain(self, query):
+        self.env.cr.execute(SQL("EXPLAIN (ANALYZE, FORMAT JSON) %s", query))
+        return self.env.cr.fetchone()[0][0]
+
+    def _plan_nodes(self, plan):
+        yield plan
+        for child in plan.get("Plans", []):
+            yield from self._plan_nodes(child)
+
+    def test_index_plans(self):
+        count = int(os.environ.get("PURCHASE_REQUEST_BENCHMARK_PLAN_LINES", 1000000))
+        vendors, products = self._generate_data(200)
+        orderpoints = self.env["stock.warehouse.orderpoint"].create(
+            [
+                {
+                    "warehouse_id": self.env.ref("stock.warehouse0").id,
+                    "location_id": self.env.ref("stock.stock_location_stock").id,
+                    "product_id": product.id,
+                    "product_min_qty": 1,
+                    "product_max_qty": 5,
+                }
+                for product in products[:20]
+            ]
+        )
+        self.env.flush_all()
+        self._generate_request_lines(count, products, vendors, orderpoints)
+        line_model = self.env["purchase.request.line"]
+        scenarios = self._get_plan_scenarios(products, vendors, orderpoints)
+        for name, (index, domain, order) in scenarios.items():
+            with self.subTest(scenario=name):
+                query = line_model._search(domain, order=order, limit=80).select()
+                plan = self._explain(query)
+                # Compare with the plan the same filter had before the index
+                self.env.cr.execute("SAVEPOINT purchase_request_benchmark_plan")
+                self.env.cr.execute(SQL("DROP INDEX %s", SQL.identifier(index)))
+                plan_without_index = self._explain(query)
+                self.env.cr.execute(
+                    "ROLLBACK TO SAVEPOINT purchase_request_benchmark_plan"
+                )
+                nodes = list(self._plan_nodes(plan["Plan"]))
+                result = {
+                    "time": round(plan["Execution Time"] / 1000, 3),
+                    "time_without_index": round(
+                        plan_without_index["Execution Time"] / 1000, 3
+                    ),
+                    "indexes": sorted(
+                        {node["Index Name"] for node in nodes if "Index Name" in node}
+                    ),
+                }
+                self.results.setdefault(f"plan_{name}", {})[str(count)] = result
+                _logger.info(
+                    "Benchmark plan %s x%s: %.3fs with %s, %.3fs without %s",
+                    name,
+                    count,
+                    result["time"],
+                    ", ".join(result["indexes"]) or "no index",
+                    result["time_without_index"],
+                    index,
+                )
+                self.assertFalse(
+                    [
+                        node
+                        for node in nodes
+                        if node["Node Type"] == "Seq Scan"
+                        and node.get("Relation Name") == "purchase_request_line"
+                    ],
+                    f"{name}: purchase_request_line is scanned sequentially",
+                )
@@ -1,8 +1,13 @@
 # Copyright 2018-2019 ForgeFlow, S.L.
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
 
+from unittest.mock import patch
+
+from psycopg2.errors import UniqueViolation
+
 from odoo import fields
 from odoo.tests import common
+from odoo.tools import mute_logger
 
 
 class TestPurchaseRequestProcurement(common.TransactionCase):
@@ -85,6 +90,10 @@ class TestPurchaseRequestProcurement(common.TransactionCase):
             qty,
         )
         self.assertEqual(orderpoint.qty_forecast, qty)
+        self.assertEqual(orderpoint.purchase_request_qty, qty)
+        # Rejected requests are not in progress anymore
+        orderpoint.purchase_request_line_ids.request_id.button_rejected()
+        self.assertEqual(orderpoint.purchase_request_qty, 0)
 
     def test_procure_purchase_request(self):
         """A request line is created from a procured move"""
@@ -97,6 +106,14 @@ class TestPurchaseRequestProcurement(common.TransactionCase):
         pr = move.created_purchase_request_line_id.request_id
         self.assertTrue(pr.to_approve_allowed)
         self.assertEqual(pr.origin, "Test Purchase Request Procurement")
+        self.assertTrue(pr.procurement_key)
+        # Only one draft request can hold a procurement key
+        with (
+            mute_logger("odoo.sql_db"),
+            self.assertRaises(UniqueViolation),
+            self.env.cr.savepoint(),
+        ):
+            pr.copy({"procurement_key": pr.procurement_key})
 
         # Now cancel the move. An activity is created on the request.
         activity = self.env.ref("mail.mail_activity_data_todo")
@@ -140,6 +157,7 @@ class TestPurchaseRequestProcurement(common.TransactionCase):
 
         # Reset the group on the first purchase request
         pr.group_id = self.env["procurement.group"].create({})
+        self.assertFalse(pr.procurement_key)
 
         # Because of the group difference, the request is not reused
         move3 = self._procurement_group_run("Test with group", self.product_1, 10)
@@ -167,3 +185,75 @@ class TestPurchaseRequestProcurement(common.TransactionCase):
         move4 = self._procurement_group_run("Split", self.product_1, 10)
         self.assertEqual(move4.created_purchase_request_line_id.request_id, pr)
         self.assertEqual(pr.origin, "Test Origin, Test, Split")
+
+    def _procurements(self, qty_origins):
+        procurement_group = self.env["procurement.group"]
+        return [
+            procurement_group.Procurement(
+                self.product_1,
+                qty,
+                self.product_1.uom_id,
+                self.location,
+                self.product_1.name,
+                origin,
+                self.env.company,
+                {
+                    "warehouse_id": self.env.ref("stock.warehouse0"),
+                    "group_id": procurement_group,
+                },
+            )
+            for qty, origin in qty_origins
+        ]
+
+    def test_procure_purchase_request_batch(self):
+        """Procurements run together are grouped in a single request"""
+        self.env["procurement.group"].run(
+            self._procurements(((5, "Batch A"), (7, "Batch B"), (3, "Batch A")))
+        )
+        pr = self.pr_model.search([("product_id", "=", self.product_1.id)])
+        self.assertEqual(len(pr), 1)
+        self.assertEqual(sorted(pr.line_ids.mapped("product_qty")), [3, 5, 7])
+        self.assertEqual(pr.origin, "Batch A, Batch B")
+
+    def test_create_purchase_request_override(self):
+        """Overrides of the deprecated per procurement hook are still called"""
+        rule_class = type(self.env["stock.rule"])
+        with patch.object(
+            rule_class,
+            "create_purchase_request",
+            autospec=True,
+            wraps=rule_class.create_purchase_request,
+        ) as create_purchase_request:
+            self.env["procurement.group"].run(
+                self._procurements(((5, "Legacy A"), (7, "Legacy B")))
+            )
+        self.assertEqual(create_purchase_request.call_count, 2)
+        pr = self.pr_model.search([("product_id", "=", self.product_1.id)])
+        self.assertEqual(len(pr), 1)
+        self.assertEqual(sorted(pr.line_ids.mapped("product_qty")), [5, 7])
+
+    def test_origin_limit(self):
+        """Origins beyond the limit are only counted, approximately"""
+        rule_model = self.env["stock.rule"]
+        with patch.object(
+            type(rule_model), "_get_purchase_request_origin_limit", return_value=2
+        ):
+            self.env["procurement.group"].run(
+                self._procurements(
+                    ((1, "SO1"), (1, "SO2"), (1, "SO3"), (1, "SO2"), (1, "SO4"))
+                )
+            )
+            pr = self.pr_model.search([("product_id", "=", self.product_1.id)])
+            self.assertEqual(pr.origin, "SO1, SO2 (+2)")
+            self.env["procurement.group"].run(self._procurements(((1, "SO5"),)))
+            self.assertEqual(pr.origin, "SO1, SO2 (+3)")
+            # Listed origins are not counted again
+            self.env["procurement.group"].run(self._procurements(((1, "SO1"),)))
+            self.assertEqual(pr.origin, "SO1, SO2 (+3)")
+            # The count is approximate: origins left out are not remembered
+            self.env["procurement.group"].run(self._procurements(((1, "SO3"),)))
+            self.assertEqual(pr.origin, "SO1, SO2 (+4)")
+        self.assertEqual(
+            rule_model._parse_purchase_request_origin("SO1, SO2 (+4)"),
+            (["SO1", "SO2"], 4),
+        )
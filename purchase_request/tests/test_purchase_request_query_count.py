@@ -0,0 +1,204 @@
+# License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
+
+from unittest.mock import patch
+
+from odoo.tests import common
+
+from odoo.addons.purchase_request.models.stock_move_line import StockMoveLine
+
+
+class TestPurchaseRequestQueryCount(common.TransactionCase):
+    """The number of queries of the main flows must not grow with the number
+    of lines.
+
+    Each flow is run for 1, 10 and 100 lines and must stay within its
+    QUERY_BUDGETS for each of them. Between 10 and 100 lines it may also
+    issue at most MAX_QUERIES_PER_LINE more queries per additional line,
+    which any query issued per line exceeds.
+    """
+
+    MAX_QUERIES_PER_LINE = 0.25
+    # Maximum number of queries of each flow for 1, 10 and 100 lines
+    QUERY_BUDGETS = {
+        "make_purchase_order": {1: 250, 10: 260, 100: 285},
+        "button_confirm": {1: 300, 10: 310, 100: 335},
+        "allocate": {1: 120, 10: 130, 100: 155},
+        "run_buy": {1: 150, 10: 160, 100: 185},
+        "quantity_in_progress": {1: 40, 10: 50, 100: 75},
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.vendor = cls.env["res.partner"].create({"name": "Query Count Vendor"})
+        cls.location = cls.env.ref("stock.stock_location_stock")
+        cls.route_buy = cls.env.ref("purchase_stock.route_warehouse0_buy")
+        cls.rule_buy = cls.route_buy.rule_ids.filtered(
+            lambda rule: rule.location_dest_id == cls.location
+        )
+        cls.warehouse = cls.env.ref("stock.warehouse0")
+
+    def _create_products(self, count, product_type="consu"):
+        return self.env["product.product"].create(
+            [
+                {
+                    "name": f"Query Count Product {product_type} {count} {i}",
+                    "type": product_type,
+                    "is_storable": product_type == "consu",
+                    "purchase_request": True,
+                    "route_ids": [(4, self.route_buy.id)],
+                    "seller_ids": [(0, 0, {"partner_id": self.vendor.id})],
+                }
+                for i in range(count)
+            ]
+        )
+
+    def _create_request(self, count, product_type="consu"):
+        request = self.env["purchase.request"].create(
+            {
+                "line_ids": [
+                    (
+                        0,
+                        0,
+                        {
+                            "product_id": product.id,
+                            "product_uom_id": product.uom_id.id,
+                            "product_qty": 5.0,
+                        },
+                    )
+                    for product in self._create_products(count, product_type)
+                ]
+            }
+        )
+        request.button_approved()
+        return request
+
+    def _make_purchase_order(self, request):
+        self.env["purchase.request.line.make.purchase.order"].with_context(
+            active_model="purchase.request.line", active_ids=request.line_ids.ids
+        ).create({"supplier_id": self.vendor.id}).make_purchase_order()
+        purchase = request.line_ids.purchase_lines.order_id
+        purchase.order_line.write({"price_unit": 10.0})
+        return purchase
+
+    def _count_queries(self, flow, prepare):
+        """Count the queries of the function returned by ``prepare(count)``
+        for 1, 10 and 100 lines, and check them against the budgets of
+        ``flow`` and their growth."""
+        budgets = self.QUERY_BUDGETS[flow]
+        counts = {}
+        for count in (1, 10, 100):
+            run = prepare(count)
+            self.env.cr.flush()
+            self.env.invalidate_all()
+            queries = self.env.cr.sql_log_count
+            run()
+            self.env.cr.flush()
+            counts[count] = self.env.cr.sql_log_count - queries
+        for count, budget in budgets.items():
+            self.assertLessEqual(
+                counts[count],
+                budget,
+                f"{flow}: queries for 1, 10 and 100 lines: {counts}",
+            )
+        self.assertLessEqual(
+            (counts[100] - counts[10]) / 90,
+            self.MAX_QUERIES_PER_LINE,
+            f"{flow}: queries for 1, 10 and 100 lines: {counts}",
+        )
+
+    def test_make_purchase_order(self):
+        def prepare(count):
+            request = self._create_request(count)
+            return lambda: self._make_purchase_order(request)
+
+        self._count_queries("make_purchase_order", prepare)
+
+    def test_button_confirm(self):
+        def prepare(count):
+            purchase = self._make_purchase_order(self._create_request(count))
+            return purchase.button_confirm
+
+        self._count_queries("button_confirm", prepare)
+
+    def test_allocate(self):
+        def prepare(count):
+            purchase = self._make_purchase_order(self._create_request(count))
+            purchase.button_confirm()
+            picking = purchase.picking_ids
+            for move in picking.move_ids:
+                move.quantity = move.product_uom_qty
+            # Validate without allocating, to only count the allocation
+            with patch.object(StockMoveLine, "allocate", autospec=True):
+                picking.button_validate()
+            return picking.move_line_ids.allocate
+
+        self._count_queries("allocate", prepare)
+
+    def test_run_buy(self):
+        procurement_group = self.env["procurement.group"]
+
+        def prepare(count):
+            procurements = [
+                (
+                    procurement_group.Procurement(
+                        product,
+                        5.0,
+                        product.uom_id,
+                        self.location,
+                        product.name,
+                        f"Query Count {count}",
+                        self.env.company,
+                        {"warehouse_id": self.warehouse, "group_id": procurement_group},
+                    ),
+                    self.rule_buy,
+                )
+                for product in self._create_products(count)
+            ]
+            return lambda: self.rule_buy._run_buy(procurements)
+
+        self._count_queries("run_buy", prepare)
+
+    def test_quantity_in_progress(self):
+        def prepare(count):
+            products = self._create_products(count)
+            orderpoints = self.env["stock.warehouse.orderpoint"].create(
+                [
+                    {
+                        "warehouse_id": self.warehouse.id,
+                        "location_id": self.location.id,
+                        "product_id": product.id,
+                        "product_min_qty": 1,
+                        "product_max_qty": 5,
+                    }
+                    for product in products
+                ]
+            )
+            self.env["purchase.request"].create(
+                {
+                    "line_ids": [
+                        (
+                            0,
+                            0,
+                            {
+                                "product_id": orderpoint.product_id.id,
+                                "product_uom_id": orderpoint.product_uom.id,
+                                "product_qty": 5.0,
+                                "orderpoint_id": orderpoint.id,
+                            },
+                        )
+                        for orderpoint in orderpoints
+                    ]
+                }
+            )
+
+            # The stored requested quantity is computed by the flush done
+            # before counting, so recompute it within the counted run
+            def run():
+                orderpoints._compute_purchase_request_qty()
+                quantities = orderpoints._quantity_in_progress()
+                self.assertEqual(set(quantities.values()), {5.0})
+
+            return run
+
+        self._count_queries("quantity_in_progress", prepare)
@@ -1,6 +1,8 @@
 # Copyright 2018-2019 ForgeFlow, S.L.
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0)
 
+from unittest.mock import patch
+
 import pytz
 
 from odoo import SUPERUSER_ID
@@ -415,3 +417,152 @@ class TestPurchaseRequestToRfq(common.TransactionCase):
         wiz_id.make_purchase_order()
         po_line = purchase_request["line_ids"][0].purchase_lines[0]
         self.assertEqual(po_line.analytic_distribution, analytic_distribution)
+
+    def test_purchase_request_to_purchase_rfq_merge_lines(self):
+        unit = self.env.ref("uom.product_uom_unit")
+        vals = {
+            "picking_type_id": self.env.ref("stock.picking_type_in").id,
+            "requested_by": SUPERUSER_ID,
+            "line_ids": [
+                (
+                    0,
+                    0,
+                    {
+                        "product_id": self.product_product.id,
+                        "product_uom_id": unit.id,
+                        "product_qty": qty,
+                    },
+                )
+                for qty in (4.0, 3.0, 2.0)
+            ],
+        }
+        purchase_request = self.purchase_request_obj.create(vals)
+        purchase_request.button_approved()
+        vals = {"supplier_id": self.env.ref("base.res_partner_12").id}
+        wiz_id = self.wiz.with_context(
+            active_model="purchase.request",
+            active_ids=purchase_request.ids,
+        ).create(vals)
+        wiz_id.make_purchase_order()
+        po_line = purchase_request.line_ids.purchase_lines
+        self.assertEqual(len(po_line), 1, "Lines should be merged in one PO line")
+        self.assertEqual(po_line.product_qty, 9.0)
+        self.assertEqual(
+            sorted(
+                po_line.purchase_request_allocation_ids.mapped(
+                    "requested_product_uom_qty"
+                )
+            ),
+            [2.0, 3.0, 4.0],
+        )
+        self.assertEqual(purchase_request.state, "in_progress")
+
+    def test_purchase_request_to_purchase_rfq_price_unit(self):
+        """The PO lines are priced from the vendor pricelist of their quantity"""
+        vendor = self.env.ref("base.res_partner_12")
+        self.env["product.supplierinfo"].create(
+            [
+                {
+                    "partner_id": vendor.id,
+                    "product_tmpl_id": self.product_product.product_tmpl_id.id,
+                    "min_qty": min_qty,
+                    "price": price,
+                }
+                for min_qty, price in ((0.0, 10.0), (8.0, 8.0))
+            ]
+        )
+        unit = self.env.ref("uom.product_uom_unit")
+        purchase_request = self.purchase_request_obj.create(
+            {
+                "picking_type_id": self.env.ref("stock.picking_type_in").id,
+                "requested_by": SUPERUSER_ID,
+                "line_ids": [
+                    (
+                        0,
+                        0,
+                        {
+                            "product_id": self.product_product.id,
+                            "product_uom_id": unit.id,
+                            "product_qty": qty,
+                        },
+                    )
+                    for qty in (4.0, 3.0)
+                ],
+            }
+        )
+        purchase_request.button_approved()
+        wiz_id = self.wiz.with_context(
+            active_model="purchase.request",
+            active_ids=purchase_request.ids,
+        ).create({"supplier_id": vendor.id})
+        wiz_id.make_purchase_order()
+        po_line = purchase_request.line_ids.purchase_lines
+        self.assertEqual(po_line.product_qty, 7.0)
+        self.assertEqual(po_line.price_unit, 10.0)
+        # Adding lines to the existing PO line honors the graduated pricing
+        request_line = self.purchase_request_line_obj.create(
+            {
+                "request_id": purchase_request.id,
+                "product_id": self.product_product.id,
+                "product_uom_id": unit.id,
+                "product_qty": 2.0,
+            }
+        )
+        wiz_id = self.wiz.with_context(
+            active_model="purchase.request.line",
+            active_ids=request_line.ids,
+        ).create({"supplier_id": vendor.id, "purchase_order_id": po_line.order_id.id})
+        wiz_id.make_purchase_order()
+        self.assertEqual(request_line.purchase_lines, po_line)
+        self.assertEqual(po_line.product_qty, 9.0)
+        self.assertEqual(po_line.price_unit, 8.0)
+
+    def test_purchase_request_to_purchase_rfq_search_domain_override(self):
+        """Overrides of the deprecated search domain hook are still honored"""
+        vendor = self.env.ref("base.res_partner_12")
+        unit = self.env.ref("uom.product_uom_unit")
+        purchase_request = self.purchase_request_obj.create(
+            {
+                "picking_type_id": self.env.ref("stock.picking_type_in").id,
+                "requested_by": SUPERUSER_ID,
+                "line_ids": [
+                    (
+                        0,
+                        0,
+                        {
+                            "product_id": self.product_product.id,
+                            "product_uom_id": unit.id,
+                            "product_qty": qty,
+                        },
+                    )
+                    for qty in (4.0, 3.0)
+                ],
+            }
+        )
+        purchase_request.button_approved()
+        line1, line2 = purchase_request.line_ids
+        self.wiz.with_context(
+            active_model="purchase.request.line", active_ids=line1.ids
+        ).create({"supplier_id": vendor.id}).make_purchase_order()
+        po_line = line1.purchase_lines
+        wiz_class = type(self.wiz)
+        base_domain = wiz_class._get_order_line_search_domain
+
+        def search_domain(wizard, order, item):
+            # Never merge with the lines of the purchase order
+            return base_domain(wizard, order, item) + [("product_qty", "<", 0.0)]
+
+        wiz_id = self.wiz.with_context(
+            active_model="purchase.request.line", active_ids=line2.ids
+        ).create({"supplier_id": vendor.id, "purchase_order_id": po_line.order_id.id})
+        with patch.object(
+            wiz_class,
+            "_get_order_line_search_domain",
+            autospec=True,
+            side_effect=search_domain,
+        ) as search_domain_mock:
+            wiz_id.make_purchase_order()
+        self.assertEqual(search_domain_mock.call_count, 1)
+        self.assertNotEqual(line2.purchase_lines, po_line)
+        self.assertEqual(line2.purchase_lines.order_id, po_line.order_id)
+        self.assertEqual(po_line.product_qty, 4.0)
@@ -1,5 +1,6 @@
 # Copyright 2018-2019 ForgeFlow, S.L.
 # License LGPL-3.0 or later (https://www.gnu.org/licenses/lgpl-3.0).
+from collections import defaultdict
 from datetime import datetime
 
 import pytz
@@ -8,6 +9,8 @@ from odoo import _, api, fields, models
 from odoo.exceptions import UserError
 from odoo.tools import get_lang
 
+from ..profiling import profiled
+
 
 class PurchaseRequestLineMakePurchaseOrder(models.TransientModel):
     _name = "purchase.request.line.make.purchase.order"
@@ -174,17 +177,28 @@ class PurchaseRequestLineMakePurchaseOrder(models.TransientModel):
             data["rfq_vendor_ids"] = [(6, 0, self.vendor_ids.ids)]
         return data
 
-    def create_allocation(self, po_line, pr_line, new_qty, alloc_uom):
-        vals = {
+    @api.model
+    def _prepare_allocation(self, po_line, pr_line, new_qty, alloc_uom):
+        return {
             "requested_product_uom_qty": new_qty,
             "product_uom_id": alloc_uom.id,
             "purchase_request_line_id": pr_line.id,
             "purchase_line_id": po_line.id,
         }
-        return self.env["purchase.request.allocation"].create(vals)
 
     @api.model
-    def _prepare_purchase_order_line(self, po, item):
+    def _create_allocations(self, vals_list):
+        return self.env["purchase.request.allocation"].create(vals_list)
+
+    def create_allocation(self, po_line, pr_line, new_qty, alloc_uom):
+        """Deprecated, the wizard creates the allocations at once with
+        ``_prepare_allocation`` and ``_create_allocations``."""
+        return self._create_allocations(
+            [self._prepare_allocation(po_line, pr_line, new_qty, alloc_uom)]
+        )
+
+    @api.model
+    def _prepare_purchase_order_line(self, po, item, min_qty_map=None):
         if not item.product_id:
             raise UserError(_("Please select a product for all lines"))
         product = item.product_id
@@ -195,7 +209,9 @@ class PurchaseRequestLineMakePurchaseOrder(models.TransientModel):
             item.product_qty, product.uom_po_id or product.uom_id
         )
         # Suggest the supplier min qty as it's done in Odoo core
-        min_qty = item.line_id._get_supplier_min_qty(product, po.partner_id)
+        min_qty = item.line_id._get_supplier_min_qty(
+            product, po.partner_id, min_qty_map=min_qty_map
+        )
         qty = max(qty, min_qty)
         date_required = item.line_id.date_required
         return {
@@ -213,26 +229,77 @@ class PurchaseRequestLineMakePurchaseOrder(models.TransientModel):
         }
 
     @api.model
-    def _get_purchase_line_name(self, order, line):
-        """Fetch the product name as per supplier settings"""
+    def _get_purchase_line_name_context(self, order):
+        """Context used to read product names as per supplier settings"""
         supplier = self._get_primary_supplier()
         lang_code = (
             supplier.lang
             if supplier and supplier.lang
             else (self.env.user.lang or "en_US")
         )
-        product_lang = line.product_id.with_context(
-            lang=get_lang(self.env, lang_code).code,
-            partner_id=supplier.id if supplier else False,
-            company_id=order.company_id.id,
+        return {
+            "lang": get_lang(self.env, lang_code).code,
+            "partner_id": supplier.id if supplier else False,
+            "company_id": order.company_id.id,
+        }
+
+    @api.model
+    def _get_purchase_line_names(self, order, products, cache=None):
+        """Fetch the product names as per supplier settings, for many products.
+
+        Names are cached by product, language, partner and company. The ones
+        not found in ``cache`` are read with a single prefetch and added to it.
+        :return: dict mapping product ids to names
+        """
+        if cache is None:
+            cache = {}
+        name_context = self._get_purchase_line_name_context(order)
+        context_key = (
+            name_context["lang"],
+            name_context["partner_id"],
+            name_context["company_id"],
+        )
+        missing = products.filtered(lambda p: (p.id, *context_key) not in cache)
+        for product_lang in missing.with_context(**name_context):
+            name = product_lang.display_name
+            if product_lang.description_purchase:
+                name += "\n" + product_lang.description_purchase
+            cache[(product_lang.id, *context_key)] = name
+        return {product.id: cache[(product.id, *context_key)] for product in products}
+
+    @api.model
+    def _get_purchase_line_name(self, order, line):
+        """Fetch the product name as per supplier settings"""
+        return self._get_purchase_line_names(order, line.product_id)[
+            line.product_id.id
+        ]
+
+    @api.model
+    def _get_purchase_line_date_planned(self, request_line):
+        """Scheduled date of the request line, as stored on the PO line.
+
+        The date is localized in the timezone of the current user, so that the
+        day shown on the RFQ is the requested one.
+        """
+        user_tz = pytz.timezone(self.env.user.tz or "UTC")
+        date_required = request_line.date_required
+        return (
+            user_tz.localize(
+                datetime(date_required.year, date_required.month, date_required.day)
+            )
+            .astimezone(pytz.utc)
+            .replace(tzinfo=None)
         )
-        name = product_lang.display_name
-        if product_lang.description_purchase:
-            name += "\n" + product_lang.description_purchase
-        return name
 
     @api.model
     def _get_order_line_search_domain(self, order, item):
+        """Deprecated, extend ``_get_order_line_merge_key`` and
+        ``_get_order_line_key`` instead.
+
+        Only used when overridden: existing PO lines are then searched with
+        the returned domain, item by item, and items are merged when their
+        domains are equal.
+        """
         vals = self._prepare_purchase_order_line(order, item)
         name = self._get_purchase_line_name(order, item)
         order_line_data = [
@@ -241,16 +308,13 @@ class PurchaseRequestLineMakePurchaseOrder(models.TransientModel):
             ("product_id", "=", item.product_id.id),
             ("product_uom", "=", vals["product_uom"]),
         ]
-
         if item.line_id.analytic_distribution:
-            analytic_account_ids = list(
-                item.line_id.analytic_distribution.keys())
+            analytic_account_ids = list(item.line_id.analytic_distribution.keys())
             order_line_data.append(
                 ("analytic_distribution", "in", analytic_account_ids)
             )
         else:
             order_line_data.append(("analytic_distribution", "=", False))
-
         if self.sync_data_planned:
             date_required = item.line_id.date_required
             order_line_data += [
@@ -266,94 +330,264 @@ class PurchaseRequestLineMakePurchaseOrder(models.TransientModel):
             order_line_data.append(("name", "=", item.name))
         return order_line_data
 
+    def _is_order_line_search_domain_overridden(self):
+        return (
+            type(self)._get_order_line_search_domain
+            is not PurchaseRequestLineMakePurchaseOrder._get_order_line_search_domain
+        )
+
+    @api.model
+    def _get_order_line_merge_key(self, order, item, names=None):
+        """Key grouping the items that end up in the same PO line.
+
+        Items are merged with an existing line of the purchase order when
+        their keys match, see ``_get_order_line_key``. ``names`` optionally
+        maps product ids to their names, as returned by
+        ``_get_purchase_line_names``.
+        """
+        product = item.product_id
+        if names is None:
+            names = self._get_purchase_line_names(order, product)
+        key = (
+            names[product.id],
+            product.id,
+            (product.uom_po_id or product.uom_id).id,
+            tuple(sorted(item.line_id.analytic_distribution or {})),
+        )
+        if self.sync_data_planned:
+            date_required = item.line_id.date_required
+            key += (
+                datetime(date_required.year, date_required.month, date_required.day),
+            )
+        return key
+
+    @api.model
+    def _get_order_line_key(self, po_line):
+        """Merge key of an existing PO line, see ``_get_order_line_merge_key``"""
+        key = (
+            po_line.name,
+            po_line.product_id.id,
+            po_line.product_uom.id,
+            tuple(sorted(po_line.analytic_distribution or {})),
+        )
+        if self.sync_data_planned:
+            key += (po_line.date_planned,)
+        return key
+
+    @api.model
+    def _get_order_line_index(self, order):
+        """Index the lines of the purchase order by merge key.
+
+        The first line, in the order of the PO, wins when several lines share
+        the same key.
+        """
+        index = {}
+        for po_line in order.order_line.filtered("product_id"):
+            index.setdefault(self._get_order_line_key(po_line), po_line)
+        return index
+
+    @api.model
+    def _prepare_po_line_slot(self, order, po_line=None, vals=None, min_qty_map=None):
+        """In-memory state of a PO line while the wizard items are merged."""
+        if po_line:
+            product = po_line.product_id
+            uom = po_line.product_uom
+            qty = po_line.product_qty
+            request_lines = po_line.purchase_request_lines
+            rl_qty = sum(
+                rl.product_uom_id._compute_quantity(rl.product_qty, uom)
+                for rl in request_lines
+            )
+        else:
+            product = self.env["product.product"].browse(vals["product_id"])
+            uom = self.env["uom.uom"].browse(vals["product_uom"])
+            qty = vals["product_qty"]
+            request_lines = self.env["purchase.request.line"]
+            rl_qty = 0.0
+        min_qty = 0.0
+        if not order.dest_address_id:
+            min_qty = self.env["purchase.request.line"]._get_supplier_min_qty(
+                product, order.partner_id, min_qty_map=min_qty_map
+            )
+        return {
+            "po_line": po_line,
+            "vals": vals,
+            "product": product,
+            "uom": uom,
+            "qty": qty,
+            "min_qty": min_qty,
+            "rl_qty": rl_qty,
+            "request_line_ids": set(request_lines.ids),
+            "new_request_line_ids": [],
+            "move_dest_ids": [],
+            "date_planned": False,
+        }
+
+    @api.model
+    def _add_item_to_po_line_slot(self, slot, item):
+        """Merge a wizard item into a PO line slot.
+
+        Return the quantity to allocate to the request line, computed as if
+        the PO line had been updated item by item. The running quantity of the
+        slot is only used for that, the final quantity of the PO line is given
+        by ``purchase.request.line._calc_new_qty``.
+        """
+        line = item.line_id
+        alloc_uom = line.product_uom_id
+        # Same conversion as reading ``product_uom_qty`` on the PO line.
+        po_line_product_uom_qty = slot["uom"]._compute_quantity(
+            slot["qty"], slot["product"].uom_id
+        )
+        po_line_qty = slot["uom"]._compute_quantity(po_line_product_uom_qty, alloc_uom)
+        wizard_qty = item.product_uom_id._compute_quantity(item.product_qty, alloc_uom)
+        if line.id not in slot["request_line_ids"]:
+            slot["request_line_ids"].add(line.id)
+            # Recompute quantity by adding existing running procurements.
+            slot["rl_qty"] += line.product_uom_id._compute_quantity(
+                line.product_qty, slot["uom"]
+            )
+        slot["new_request_line_ids"].append(line.id)
+        slot["move_dest_ids"] += line.move_dest_ids.ids
+        slot["qty"] = max(slot["rl_qty"], slot["min_qty"])
+        slot["date_planned"] = self._get_purchase_line_date_planned(line)
+        return min(po_line_qty, wizard_qty)
+
+    @profiled(records=lambda self: len(self.item_ids))
     def make_purchase_order(self):
-        res = []
         purchase_obj = self.env["purchase.order"]
         po_line_obj = self.env["purchase.order.line"]
         pr_line_obj = self.env["purchase.request.line"]
-        user_tz = pytz.timezone(self.env.user.tz or "UTC")
-        purchase = False
-
         for item in self.item_ids:
-            line = item.line_id
             if item.product_qty <= 0.0:
                 raise UserError(_("Enter a positive quantity."))
-            if self.purchase_order_id:
-                purchase = self.purchase_order_id
-                self._apply_selected_vendors(purchase)
-            if not purchase:
-                po_data = self._prepare_purchase_order(
-                    line.request_id.picking_type_id,
-                    line.request_id.group_id,
-                    line.company_id,
-                    line.origin,
-                )
-                purchase = purchase_obj.create(po_data)
-                self._apply_selected_vendors(purchase)
-
-            # Look for any other PO line in the selected PO with same
-            # product and UoM to sum quantities instead of creating a new
-            # po line
-            domain = self._get_order_line_search_domain(purchase, item)
-            available_po_lines = po_line_obj.search(domain)
-            new_pr_line = True
-            # If Unit of Measure is not set, update from wizard.
-            if not line.product_uom_id:
-                line.product_uom_id = item.product_uom_id
-            # Allocation UoM has to be the same as PR line UoM
-            alloc_uom = line.product_uom_id
-            wizard_uom = item.product_uom_id
-            if available_po_lines and not item.keep_description:
-                new_pr_line = False
-                po_line = available_po_lines[0]
-                po_line.purchase_request_lines = [(4, line.id)]
-                po_line.move_dest_ids |= line.move_dest_ids
-                po_line_product_uom_qty = po_line.product_uom._compute_quantity(
-                    po_line.product_uom_qty, alloc_uom
-                )
-                wizard_product_uom_qty = wizard_uom._compute_quantity(
-                    item.product_qty, alloc_uom
-                )
-                all_qty = min(po_line_product_uom_qty, wizard_product_uom_qty)
-                self.create_allocation(po_line, line, all_qty, alloc_uom)
-            else:
-                po_line_data = self._prepare_purchase_order_line(
-                    purchase, item)
-                if item.keep_description:
-                    po_line_data["name"] = item.name
-                po_line = po_line_obj.create(po_line_data)
-                po_line_product_uom_qty = po_line.product_uom._compute_quantity(
-                    po_line.product_uom_qty, alloc_uom
-                )
-                wizard_product_uom_qty = wizard_uom._compute_quantity(
-                    item.product_qty, alloc_uom
-                )
-                all_qty = min(po_line_product_uom_qty, wizard_product_uom_qty)
-                self.create_allocation(po_line, line, all_qty, alloc_uom)
-            # TODO: Check propagate_uom compatibility:
-            new_qty = pr_line_obj._calc_new_qty(
-                line, po_line=po_line, new_pr_line=new_pr_line
+            if not item.product_id:
+                raise UserError(_("Please select a product for all lines"))
+        purchase = self.purchase_order_id
+        if not purchase and self.item_ids:
+            line = self.item_ids[0].line_id
+            po_data = self._prepare_purchase_order(
+                line.request_id.picking_type_id,
+                line.request_id.group_id,
+                line.company_id,
+                line.origin,
             )
-            po_line.product_qty = new_qty
-            # The quantity update triggers a compute method that alters the
-            # unit price (which is what we want, to honor graduate pricing)
-            # but also the scheduled date which is what we don't want.
-            date_required = item.line_id.date_required
-            # we enforce to save the datetime value in the current tz of the user
-            po_line.date_planned = (
-                user_tz.localize(
-                    datetime(date_required.year,
-                             date_required.month, date_required.day)
+            purchase = purchase_obj.create(po_data)
+        if purchase:
+            self._apply_selected_vendors(purchase)
+        # If Unit of Measure is not set, update from wizard.
+        for item in self.item_ids.filtered(lambda i: not i.line_id.product_uom_id):
+            item.line_id.product_uom_id = item.product_uom_id
+
+        # Look for any other PO line in the selected PO with same product and
+        # UoM to sum quantities instead of creating a new po line. Items are
+        # grouped by merge key, and matched against the lines of the PO
+        # loaded once.
+        po_line_index = {}
+        search_domain_overridden = self._is_order_line_search_domain_overridden()
+        if self.purchase_order_id and not search_domain_overridden:
+            po_line_index = self._get_order_line_index(purchase)
+        products = self.item_ids.product_id
+        names = self._get_purchase_line_names(purchase, products)
+        min_qty_map = self.env["purchase.request.line"]._get_supplier_min_qty_map(
+            products, purchase.partner_id
+        )
+        slots = []
+        slots_by_key = {}
+        slots_by_po_line = {}
+        allocations = []
+        for item in self.item_ids:
+            key = False
+            slot = None
+            if not item.keep_description and search_domain_overridden:
+                domain = self._get_order_line_search_domain(purchase, item)
+                key = repr(domain)
+                slot = slots_by_key.get(key)
+                if slot is None and self.purchase_order_id:
+                    po_line_index[key] = po_line_obj.search(domain, limit=1)
+            elif not item.keep_description:
+                key = self._get_order_line_merge_key(purchase, item, names=names)
+                slot = slots_by_key.get(key)
+            if slot is None:
+                po_line = key and po_line_index.get(key)
+                if po_line:
+                    slot = slots_by_po_line.get(po_line.id)
+                    if slot is None:
+                        slot = self._prepare_po_line_slot(
+                            purchase, po_line=po_line, min_qty_map=min_qty_map
+                        )
+                        slots_by_po_line[po_line.id] = slot
+                        slots.append(slot)
+                else:
+                    po_line_data = self._prepare_purchase_order_line(
+                        purchase, item, min_qty_map=min_qty_map
+                    )
+                    if item.keep_description:
+                        po_line_data["name"] = item.name
+                    slot = self._prepare_po_line_slot(
+                        purchase, vals=po_line_data, min_qty_map=min_qty_map
+                    )
+                    slots.append(slot)
+                if key:
+                    slots_by_key[key] = slot
+            all_qty = self._add_item_to_po_line_slot(slot, item)
+            allocations.append((slot, item.line_id, all_qty))
+
+        new_slots = [slot for slot in slots if not slot["po_line"]]
+        vals_list = []
+        for slot in new_slots:
+            vals = slot["vals"]
+            vals["purchase_request_lines"] = [
+                (4, rl_id) for rl_id in slot["new_request_line_ids"]
+            ]
+            vals["move_dest_ids"] = [(4, m_id) for m_id in slot["move_dest_ids"]]
+            vals_list.append(vals)
+        for slot, po_line in zip(new_slots, po_line_obj.create(vals_list), strict=True):
+            slot["po_line"] = po_line
+        for slot in slots:
+            if slot["vals"]:
+                continue
+            slot["po_line"].write(
+                {
+                    "purchase_request_lines": [
+                        (4, rl_id) for rl_id in slot["new_request_line_ids"]
+                    ],
+                    "move_dest_ids": [(4, m_id) for m_id in slot["move_dest_ids"]],
+                }
+            )
+        self._create_allocations(
+            [
+                self._prepare_allocation(
+                    slot["po_line"], pr_line, all_qty, pr_line.product_uom_id
                 )
-                .astimezone(pytz.utc)
-                .replace(tzinfo=None)
+                for slot, pr_line, all_qty in allocations
+            ]
+        )
+        # The quantity update triggers a compute method that alters the unit
+        # price (which is what we want, to honor graduate pricing) but also
+        # the scheduled date which is what we don't want, so the date is
+        # written afterwards. Lines sharing the same values are written at
+        # once, the others with one write each.
+        po_lines_by_qty = defaultdict(list)
+        po_lines_by_date = defaultdict(list)
+        for slot in slots:
+            po_line = slot["po_line"]
+            new_qty = pr_line_obj._calc_new_qty(
+                pr_line_obj.browse(slot["new_request_line_ids"][-1]),
+                po_line=po_line,
+                new_pr_line=bool(slot["vals"]),
+                min_qty_map=min_qty_map,
             )
-            res.append(purchase.id)
+            po_lines_by_qty[new_qty].append(po_line.id)
+            po_lines_by_date[slot["date_planned"]].append(po_line.id)
+        for qty, po_line_ids in po_lines_by_qty.items():
+            po_line_obj.browse(po_line_ids).write({"product_qty": qty})
+        for date_planned, po_line_ids in po_lines_by_date.items():
+            po_line_obj.browse(po_line_ids).write({"date_planned": date_planned})
 
         purchase_requests = self.item_ids.mapped("request_id")
         purchase_requests.button_in_progress()
         return {
-            "domain": [("id", "in", res)],
+            "domain": [("id", "in", purchase.ids)],
             "name": _("RFQ"),
             "view_mode": "list,form",
             "res_model": "purchase.order",